@@ -14,11 +14,16 @@ LOAD_ORDER = [
     # base
     '',
     '.util',
+    '.diffparse',
+    '.worker',
+    '.state',
+    '.watcher',
     '.cmd',
     '.helpers',
 
     # commands
     '.help',
+    '.jobs',
     '.cli',
     '.repo',
     '.diff',
@@ -75,6 +80,8 @@ if sys.version_info[0] == 2:
     git_extensions.git_flow.enabled = settings.get('git_extensions', {}).get('git_flow', True)
 
     def unload_handler():
+        cmd.shutdown_cat_files()
+        watcher.stop_watchers()
         logging.shutdown()
 else:
     from .sgit import *  # noqa
@@ -98,4 +105,6 @@ else:
         git_extensions.git_flow.enabled = settings.get('git_extensions', {}).get('git_flow', True)
 
     def plugin_unloaded():
+        cmd.shutdown_cat_files()
+        watcher.stop_watchers()
         logging.shutdown()
@@ -14,7 +14,7 @@ from .custom import GitCustomCommand, GitCustomOutputCommand
 from .diff import (GitDiffCommand, GitDiffCachedCommand, GitDiffRefreshCommand, GitDiffMoveCommand,
                    GitDiffChangeHunkSizeCommand, GitDiffStageUnstageHunkCommand, GitDiffCurrentFileCommand,
                    GitDiffCachedCurrentFileCommand, GitDiffEditHunkCommand, GitDiffDiscardHunkCommand,
-                   GitDiffEventListener)
+                   GitDiffAppendCommand, GitDiffToggleFileCommand, GitDiffEventListener)
 
 from .show import GitShowCommand, GitShowRefreshCommand
 
@@ -22,6 +22,8 @@ from .help import GitHelpCommand, GitVersionCommand
 
 from .gc import GitGarbageCollectCommand
 
+from .jobs import GitCancelOperationsCommand
+
 from .log import GitLogCommand, GitQuickLogCommand, GitQuickLogCurrentFileCommand
 
 from .blame import (GitBlameCommand, GitBlameRefreshCommand, GitBlameShowCommand,
@@ -33,11 +35,12 @@ from .remote import (GitPublishCurrentBranchCommand, GitPullOtherBranchCommand,
                      GitRemoteCommand, GitRemoteAddCommand)
 
 from .status import (GitStatusCommand, GitStatusReplaceCommand, GitStatusRefreshCommand, GitQuickStatusCommand,
-                     GitStatusMoveCommand, GitStatusStageCommand,
+                     GitStatusMoveCommand, GitStatusToggleSectionCommand, GitStatusStageCommand,
                      GitStatusUnstageCommand, GitStatusDiscardCommand,
                      GitStatusOpenFileCommand, GitStatusDiffCommand,
                      GitStatusIgnoreCommand, GitStatusStashCmd, GitStatusStashApplyCommand,
-                     GitStatusStashPopCommand, GitStatusCheckoutCommand)
+                     GitStatusStashPopCommand, GitStatusCheckoutCommand,
+                     GitLargeRepoDiagnosticsCommand)
 from .status import GitStatusBarEventListener, GitStatusEventListener
 
 from .add import GitQuickAddCommand, GitAddCurrentFileCommand
@@ -1,128 +1,267 @@
 # coding: utf-8
 import os
-import sys
+import re
+import time
 import subprocess
 import logging
 import threading
-import webbrowser
-import queue
+import itertools
 from datetime import datetime
 from functools import partial
-import sys
-import traceback
-
-def get_thread_stack(thread):
-    frame = sys._current_frames().get(thread.ident, None)
-    if not frame:
-        return []
-
-    return traceback.format_stack(f=frame)
 
 import sublime
 
 from .util import get_executable, get_setting, text_type
 from .helpers import GitRepoHelper
+from .state import repo_states
+from .worker import (Job, JobResult, JobError, JobDropped, JobCancelled, JobTimeout, scheduler, job_timeout,
+                     on_ui_thread, PRIORITY_INTERACTIVE)
 
 
 logger = logging.getLogger('SublimeGit.cmd')
 worker_logger = logging.getLogger('SublimeGitWorker')
 
-class JobError(Exception):
-    pass
-
-worker_queue = queue.Queue(1)
-output_queue = {}
-output_queue_lock = threading.Lock()
-last_task_id = 0
-max_tries = 100
-
-def get_output_queue(task_id):
-    global output_queue_lock
-    global output_queue
+task_ids = itertools.count(1)
 
-    with output_queue_lock:
-        if not task_id in output_queue:
-            output_queue[task_id] = queue.Queue(1)
+# output of `git version --build-options` for each executable
+git_builds = {}
 
-        return output_queue[task_id]
+# extra options for each repository in large repository mode
+large_repo_opts = {}
 
-def release_output_queue(task_id):
-    global output_queue_lock
-    global output_queue
-
-    with output_queue_lock:
-        if task_id in output_queue:
-            del output_queue[task_id]
-
-def process_queue_one():
-    task_id, job = worker_queue.get(timeout=1)
-    worker_logger.info("[%s,%s] got input, processing...", threading.get_ident(), task_id)
-
-    try:
-        outputs = job()
-        worker_logger.info("[%s,%s] got output, sending...", threading.get_ident(), task_id)
-    except Exception as e:
-        worker_logger.warning("[%s,%s] got error: %s\n%s", threading.get_ident(), task_id, e, traceback.format_exc())
-        worker_logger.warning("[%s,%s] sending...", threading.get_ident(), task_id)
-        outputs = JobError("Unhandled exception in queue command: %s" % e)
+def next_task_id():
+    return next(task_ids)
 
-    get_output_queue(task_id).put(outputs, timeout=1)
+def dump_stack(operation, task_id):
+    scheduler.dump_stacks(operation, task_id)
+
+def new_job(task_id, func, on_done, lane=None, priority=PRIORITY_INTERACTIVE, target=None, key=None, description=None):
+    job = Job(task_id, func, on_done, priority, target, key, description)
+    if key is not None and lane:
+        # a running job can only be shared if it started after the last
+        # change to the repository
+        job.fresh_after = repo_states.touched_at(lane)
+    return job
+
+def push_new_job(task_id, job, on_done, lane=None, priority=PRIORITY_INTERACTIVE, target=None, key=None, description=None):
+    return scheduler.submit(lane, new_job(task_id, job, on_done, lane, priority, target, key, description))
+
+
+class CatFile(object):
+    """
+    A long-lived ``git cat-file --batch`` (or ``--batch-check``) process
+    for a single repository.
+
+    Object names are written to its stdin one per line and answered in
+    the same order on stdout, so several objects can be requested in one
+    go without waiting for each answer. The process is restarted if it
+    dies, and stopped after it has been idle for a while.
+    """
+
+    # requests larger than this are written from a separate thread, so
+    # git can not block on a full stdout pipe while we are still writing
+    PIPELINE_SIZE = 4096
+
+    def __init__(self, command, cwd, env, startupinfo, check=False):
+        self.command = command + ['cat-file', '--batch-check' if check else '--batch']
+        self.cwd = cwd
+        self.env = env
+        self.startupinfo = startupinfo
+        self.check = check
+        self.lock = threading.Lock()
+        self.proc = None
+        self.timer = None
+        self.last_used = 0
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        logger.debug('cat-file start: %s (%s)', self.command, self.cwd)
+        self.proc = subprocess.Popen(self.command,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     cwd=self.cwd,
+                                     start_new_session=True,
+                                     startupinfo=self.startupinfo,
+                                     env=self.env)
+
+    def close(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        logger.debug('cat-file stop: %s (%s)', self.command, self.cwd)
+        try:
+            proc.stdin.close()
+            proc.wait(1)
+        except Exception:
+            proc.kill()
+
+    def read(self, names):
+        with self.lock:
+            self.last_used = time.time()
+            try:
+                for attempt in range(2):
+                    if not self.is_alive():
+                        self.start()
+                    try:
+                        return self.request(names)
+                    except (IOError, OSError, ValueError) as e:
+                        logger.info('cat-file failed, restarting: %s', e)
+                        self.close()
+                        if attempt:
+                            raise
+            finally:
+                self.schedule_close()
+
+    def request(self, names):
+        # names which can not be sent on a single line can not exist either
+        lines = [n.encode('utf-8') if hasattr(n, 'encode') else n for n in names]
+        sent = [l for l in lines if b'\n' not in l]
+        data = b''.join(l + b'\n' for l in sent)
+
+        if len(data) <= self.PIPELINE_SIZE:
+            self.write(data)
+        else:
+            threading.Thread(target=self.write, args=(data,)).start()
 
-    worker_logger.info("[%s,%s] sent", threading.get_ident(), task_id)
+        answers = [self.read_one() for _ in sent]
+        answers.reverse()
+        return [answers.pop() if b'\n' not in l else None for l in lines]
 
-def process_queue():
-    while True:
+    def write(self, data):
         try:
-            worker_logger.debug("wait for input...")
-            process_queue_one()
-        except:
-            worker_logger.debug("no input")
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (IOError, OSError, AttributeError):
+            # reading will notice that the process is gone
             pass
 
-def next_task_id():
-    global last_task_id
-    last_task_id += 1
-    task_id = last_task_id
-    return task_id
+    def read_one(self):
+        header = self.proc.stdout.readline()
+        if not header:
+            raise IOError("git cat-file exited")
 
-def dump_stack(operation, task_id):
-    worker_logger.warning("[%s,%s] %s worker thread stack:", threading.get_ident(), task_id, operation)
-    for entry in get_thread_stack(worker_thread):
-        worker_logger.warning("[%s,%s] " + entry.replace('\r', '').split('\n')[0], threading.get_ident(), task_id)
+        header = header.rstrip(b'\n')
+        if header.endswith(b' missing') or header.endswith(b' ambiguous'):
+            return None
 
-def push_new_job(task_id, job):
-    num_tries = 0
-    while True:
+        sha, kind, size = header.split(b' ')
+        size = int(size)
+        if self.check:
+            return (sha.decode('ascii'), kind.decode('ascii'), size)
+
+        data = self.proc.stdout.read(size)
+        if len(data) != size or self.proc.stdout.read(1) != b'\n':
+            raise IOError("git cat-file sent a short object")
+        return (sha.decode('ascii'), kind.decode('ascii'), data)
+
+    # idle shutdown
+    def idle_timeout(self):
         try:
-            worker_queue.put((task_id, job), timeout=0.1)
+            return float(get_setting('git_cat_file_idle_timeout', 60))
+        except (TypeError, ValueError):
+            return 60.0
+
+    def schedule_close(self):
+        timeout = self.idle_timeout()
+        if timeout <= 0:
+            self.close()
+        elif self.timer is None:
+            self.timer = threading.Timer(timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        with self.lock:
+            self.timer = None
+            remaining = self.last_used + self.idle_timeout() - time.time()
+            if remaining > 0 and self.is_alive():
+                self.timer = threading.Timer(remaining, self.expire)
+                self.timer.daemon = True
+                self.timer.start()
+            else:
+                self.close()
+
+
+cat_files = {}
+cat_files_lock = threading.Lock()
+
+def get_cat_file(command, cwd, env, startupinfo, check=False):
+    key = (tuple(command), cwd, check)
+    with cat_files_lock:
+        if key not in cat_files:
+            cat_files[key] = CatFile(command, cwd, env, startupinfo, check)
+        return cat_files[key]
+
+def shutdown_cat_files():
+    with cat_files_lock:
+        readers = list(cat_files.values())
+        cat_files.clear()
+    for reader in readers:
+        with reader.lock:
+            if reader.timer is not None:
+                reader.timer.cancel()
+            reader.close()
+
+
+class AsyncJob(object):
+    """
+    Handle for a job running on the worker pool.
+
+    It can be passed to StatusSpinner like a thread, and cancelled with
+    cancel(). Once cancelled, none of the callbacks will be called.
+    """
+
+    def __init__(self, task_id, func, lane, priority, target=None, key=None, description=None,
+                 on_complete=None, on_exception=None):
+        self.task_id = task_id
+        self.func = func
+        self.lane = lane
+        self.priority = priority
+        self.target = target
+        self.key = key
+        self.description = description
+        self.on_complete = on_complete
+        self.on_exception = on_exception
+        self.job = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def start(self):
+        worker_logger.info("[%s,%s] async new input, sending...", threading.get_ident(), self.task_id)
+        job = new_job(self.task_id, self.func, self.on_done, self.lane, self.priority, self.target, self.key, self.description)
+        self.job = scheduler.submit(self.lane, job)
+
+    def is_alive(self):
+        return self.job is not None and not self.done.is_set()
+
+    def cancel(self):
+        if self.job is None or self.done.is_set():
             return
-        except Exception as e:
-            worker_logger.debug("[%s,%s] put timed out, waiting some more...", threading.get_ident(), task_id)
-            num_tries += 1
-            if num_tries == max_tries:
-                dump_stack('put', task_id)
-                raise e
-
-def get_job_output(task_id):
-    try:
-        num_tries = 0
-        queue = get_output_queue(task_id)
-
-        while True:
-            try:
-                return queue.get(timeout=0.1)
-            except Exception as e:
-                worker_logger.debug("[%s,%s] get timed out, waiting some more...", threading.get_ident(), task_id)
-                num_tries += 1
-                if num_tries == max_tries:
-                    dump_stack('get', task_id)
-                    raise e
-
-    finally:
-        release_output_queue(task_id)
+        self.cancelled = True
+        scheduler.cancel(self.job, self.on_done)
+        self.done.set()
+
+    def on_done(self, outputs):
+        self.done.set()
+        task_id = self.task_id
+
+        if self.cancelled or isinstance(outputs, JobCancelled):
+            worker_logger.info("[%s,%s] async cancelled", threading.get_ident(), task_id)
+        elif isinstance(outputs, JobDropped):
+            worker_logger.info("[%s,%s] async dropped: %s", threading.get_ident(), task_id, outputs)
+        elif isinstance(outputs, Exception):
+            worker_logger.info("[%s,%s] async got error", threading.get_ident(), task_id)
+            logger.debug('async-exception: %s', outputs)
+            if callable(self.on_exception):
+                sublime.set_timeout(partial(self.on_exception, outputs), 0)
+        else:
+            worker_logger.info("[%s,%s] async got output", threading.get_ident(), task_id)
+            if callable(self.on_complete):
+                sublime.set_timeout(partial(self.on_complete, outputs), 0)
 
-worker_thread = threading.Thread(target=process_queue)
-worker_thread.start()
 
 class Cmd(object):
     started_at = datetime.today()
@@ -132,6 +271,12 @@ class Cmd(object):
     bin = []
     opts = []
 
+    # priority class of the git jobs queued by this command
+    priority = PRIORITY_INTERACTIVE
+
+    # subcommands which never change the repository
+    read_only = ()
+
     # cmd helpers
     def _string(self, cmd, strip=True, *args, **kwargs):
         _, stdout, _ = self.cmd(cmd, *args, **kwargs)
@@ -148,9 +293,12 @@ class Cmd(object):
         exit, _, _ = self.cmd(cmd, *args, **kwargs)
         return exit
 
-    def build_command(self, cmd):
+    def build_command(self, cmd, cwd=None):
         bin = get_executable(self.executable, self.bin)
-        return bin + self.opts + [c for c in cmd if c]
+        return bin + self.opts + self.repo_opts(cwd) + [c for c in cmd if c]
+
+    def repo_opts(self, cwd):
+        return []
 
     def env(self):
         env = os.environ.copy()
@@ -185,23 +333,50 @@ class Cmd(object):
                         pass
             raise
 
-    def worker_run(self, job, task_id=None):
+    def is_read_only(self, cmd):
+        subcommand = next((c for c in cmd if c), None)
+        return subcommand in self.read_only
+
+    def command_done(self, cmd, cwd, priority):
+        # commands run on behalf of the user may have changed anything
+        # in the repository, so whatever is known about it is stale now
+        if cwd and priority == PRIORITY_INTERACTIVE and not self.is_read_only(cmd):
+            repo_states.invalidate(cwd)
+
+    def get_lane(self, cwd=None):
+        # jobs are serialized per repository
+        if not cwd:
+            return None
+        return self.first_git_repo(cwd) or cwd
+
+    def worker_run(self, job, task_id=None, repo=None, priority=None, key=None, description=None):
         if not task_id:
             task_id = next_task_id()
 
         worker_logger.info("[%s,%s] running task", threading.get_ident(), task_id)
 
-        if threading.get_ident() == worker_thread.ident:
-            # We are already in the worker thread, execute immediately
+        if scheduler.in_worker():
+            # We are already in a worker thread, execute immediately
             worker_logger.info("[%s,%s] immediate call", threading.get_ident(), task_id)
             outputs = job()
         else:
-            # Schedule on the worker thread and wait for the output now
+            # Schedule on the worker pool and wait for the output now
+            priority = self.priority if priority is None else priority
+            ui = on_ui_thread()
+            result = JobResult()
             try:
                 worker_logger.info("[%s,%s] new input, sending...", threading.get_ident(), task_id)
-                push_new_job(task_id, job)
+                queued = push_new_job(task_id, job, result.set, self.get_lane(repo), priority,
+                                      key=key, description=description)
                 worker_logger.info("[%s,%s] wait for output...", threading.get_ident(), task_id)
-                outputs = get_job_output(task_id)
+                outputs = result.wait(job_timeout(priority, ui))
+            except JobTimeout as e:
+                # the job keeps running, but nobody is waiting for it anymore
+                scheduler.detach(queued, result.set)
+                dump_stack('get', task_id)
+                if ui:
+                    self.show_busy_message(queued)
+                outputs = JobError("Could not execute command: %s waiting for %s" % (e, queued.description))
             except Exception as e:
                 outputs = JobError("Could not execute command: %s" % e)
 
@@ -212,42 +387,44 @@ class Cmd(object):
         worker_logger.info("[%s,%s] got output: %s", threading.get_ident(), task_id, str(outputs)[:32])
         return outputs
 
-    def worker_run_async(self, job, on_complete=None, on_exception=None, task_id=None):
+    def show_busy_message(self, queued):
+        busy = scheduler.running_job(queued.lane.key) if queued.lane is not None else None
+        if busy is None or busy is queued:
+            message = "Gave up waiting for %s." % queued.description
+        else:
+            message = ("Gave up waiting for %s, as git is still busy with %s. "
+                       "Try again once it is done, or use Git: Cancel Running Operations." % (queued.description, busy.description))
+        if queued.priority == PRIORITY_INTERACTIVE:
+            sublime.error_message(message)
+        else:
+            sublime.status_message(message)
+
+    def worker_run_async(self, job, on_complete=None, on_exception=None, task_id=None, repo=None, priority=None,
+                         target=None, key=None, description=None):
         if not task_id:
             task_id = next_task_id()
 
         worker_logger.info("[%s,%s] running async task", threading.get_ident(), task_id)
 
-        # Spawn a thread to schedule the job on the worker thread and wait for the output
-        def async_inner(on_complete, on_exception, task_id):
-            try:
-                worker_logger.info("[%s,%s] async new input, sending...", threading.get_ident(), task_id)
-                push_new_job(task_id, job)
-                worker_logger.info("[%s,%s] async wait for output...", threading.get_ident(), task_id)
-                outputs = get_job_output(task_id)
-            except Exception as e:
-                outputs = JobError("Could not execute command: %s" % e)
-
-            if isinstance(outputs, Exception):
-                worker_logger.info("[%s,%s] async got error", threading.get_ident(), task_id)
-                logger.debug('async-exception: %s', outputs)
-                if callable(on_exception):
-                    sublime.set_timeout(partial(on_exception, outputs), 0)
-            else:
-                worker_logger.info("[%s,%s] async got output", threading.get_ident(), task_id)
-                if callable(on_complete):
-                    sublime.set_timeout(partial(on_complete, outputs), 0)
-
-        return threading.Thread(target=partial(async_inner, on_complete, on_exception, task_id))
+        return AsyncJob(task_id, job, self.get_lane(repo), self.priority if priority is None else priority,
+                        target=target, key=key, description=description,
+                        on_complete=on_complete, on_exception=on_exception)
 
     # sync commands
-    def cmd(self, cmd, stdin=None, cwd=None, ignore_errors=False, encoding=None, fallback=None):
-        command = self.build_command(cmd)
+    def cmd(self, cmd, stdin=None, cwd=None, ignore_errors=False, encoding=None, fallback=None, priority=None):
+        command = self.build_command(cmd, cwd)
         environment = self.env()
         encoding = encoding or get_setting('encoding', 'utf-8')
         fallback = fallback or get_setting('fallback_encodings', [])
+        priority = self.priority if priority is None else priority
         task_id = next_task_id()
 
+        # identical read-only commands which are already queued or running
+        # are only run once, anything else runs as often as it is asked to
+        key = None
+        if self.is_read_only(cmd):
+            key = (tuple(command), cwd, stdin, ignore_errors, encoding, tuple(fallback))
+
         logger.debug("[%s,%s] cmd: %s", threading.get_ident(), task_id, command)
 
         def job(command, stdin, cwd, environment, ignore_errors, encoding, fallback, task_id):
@@ -255,16 +432,18 @@ class Cmd(object):
                 if stdin and hasattr(stdin, 'encode'):
                     stdin = stdin.encode(encoding)
 
-                if cwd:
-                    os.chdir(cwd)
-
+                scheduler.check_cancelled()
                 proc = subprocess.Popen(command,
                                         stdin=subprocess.PIPE,
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.PIPE,
+                                        cwd=cwd or None,
+                                        start_new_session=True,
                                         startupinfo=self.startupinfo(),
                                         env=environment)
+                scheduler.attach_process(proc)
                 stdout, stderr = proc.communicate(stdin)
+                self.command_done(cmd, cwd, priority)
 
                 logger.debug("[%s,%s] out: (%s) %s", threading.get_ident(), task_id, proc.returncode, [stdout[:100]])
 
@@ -280,27 +459,31 @@ class Cmd(object):
                 sublime.error_message(self.get_decoding_error(encoding, fallback))
                 return JobError("[%s,%s] Could not execute command: %s" % (threading.get_ident(), task_id, command))
 
-        return self.worker_run(partial(job, command, stdin, cwd, environment, ignore_errors, encoding, fallback, task_id), task_id=task_id)
+        return self.worker_run(partial(job, command, stdin, cwd, environment, ignore_errors, encoding, fallback, task_id),
+                               task_id=task_id, repo=cwd, priority=priority, key=key,
+                               description=self.describe_command(cmd, cwd))
 
     # async commands
-    def cmd_async(self, cmd, cwd=None, with_stderr=True, on_data=None, on_complete=None, on_error=None, on_exception=None):
-        command = self.build_command(cmd)
+    def cmd_async(self, cmd, cwd=None, with_stderr=True, on_data=None, on_complete=None, on_error=None, on_exception=None, priority=None):
+        command = self.build_command(cmd, cwd)
         environment = self.env()
         encoding = get_setting('encoding', 'utf-8')
         fallback = get_setting('fallback_encodings', [])
+        priority = self.priority if priority is None else priority
         task_id = next_task_id()
 
         logger.debug('[%s,%s] async-cmd: %s', threading.get_ident(), task_id, command)
 
         def job(command, cwd, encoding, on_data, task_id):
-            if cwd:
-                os.chdir(cwd)
-
+            scheduler.check_cancelled()
             proc = subprocess.Popen(command,
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.STDOUT if with_stderr else subprocess.DEVNULL,
+                                    cwd=cwd or None,
+                                    start_new_session=True,
                                     startupinfo=self.startupinfo(),
                                     env=environment)
+            scheduler.attach_process(proc)
 
             for line in iter(proc.stdout.readline, b''):
                 logger.debug('[%s,%s] async-out: %s', threading.get_ident(), task_id, line.strip())
@@ -309,6 +492,7 @@ class Cmd(object):
                     sublime.set_timeout(partial(on_data, line), 0)
 
             proc.wait()
+            self.command_done(cmd, cwd, priority)
             logger.debug('[%s,%s] async-exit: %s', threading.get_ident(), task_id, proc.returncode)
 
             return proc.returncode
@@ -322,9 +506,68 @@ class Cmd(object):
                     sublime.set_timeout(partial(on_error, return_code), 0)
 
         return self.worker_run_async(partial(job, command, cwd, encoding, on_data, task_id),
-            on_complete=partial(on_complete_inner, on_complete, on_error),
+            on_complete=partial(on_complete_inner, on_complete=on_complete, on_error=on_error),
             on_exception=on_exception,
-            task_id=task_id)
+            task_id=task_id,
+            repo=cwd,
+            priority=priority,
+            description=self.describe_command(cmd, cwd))
+
+    def cmd_stream(self, cmd, cwd=None, on_chunk=None, on_complete=None, on_exception=None, priority=None,
+                   target=None, chunk_size=65536):
+        """
+        Run a command in the worker, handing its raw output to on_chunk in
+        pieces as it arrives. on_chunk is called in the worker, and
+        on_complete with the exit code once the output has been read.
+        """
+        command = self.build_command(cmd, cwd)
+        environment = self.env()
+        priority = self.priority if priority is None else priority
+        task_id = next_task_id()
+
+        logger.debug('[%s,%s] stream-cmd: %s', threading.get_ident(), task_id, command)
+
+        def job(command, cwd, on_chunk, task_id):
+            try:
+                scheduler.check_cancelled()
+                proc = subprocess.Popen(command,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        cwd=cwd or None,
+                                        start_new_session=True,
+                                        startupinfo=self.startupinfo(),
+                                        env=environment)
+                scheduler.attach_process(proc)
+
+                # a cancelled job has its process terminated, which ends the output
+                for chunk in iter(partial(proc.stdout.read1, chunk_size), b''):
+                    if callable(on_chunk):
+                        on_chunk(chunk)
+
+                proc.wait()
+                self.command_done(cmd, cwd, priority)
+                logger.debug('[%s,%s] stream-exit: %s', threading.get_ident(), task_id, proc.returncode)
+
+                return proc.returncode
+            except OSError as e:
+                sublime.error_message(self.get_executable_error())
+                return JobError("[%s,%s] Could not execute command: %s" % (threading.get_ident(), task_id, e))
+
+        return self.worker_run_async(partial(job, command, cwd, on_chunk, task_id),
+                                     on_complete=on_complete,
+                                     on_exception=on_exception,
+                                     task_id=task_id,
+                                     repo=cwd,
+                                     priority=priority,
+                                     target=target,
+                                     description=self.describe_command(cmd, cwd))
+
+    def describe_command(self, cmd, cwd=None):
+        bin = [os.path.basename(self.bin[0])] + self.bin[1:] if self.bin else []
+        description = " ".join(bin + [c for c in cmd if c])
+        if cwd:
+            description += " (%s)" % os.path.basename(cwd.rstrip(os.sep))
+        return description
 
     # messages
     EXECUTABLE_ERROR = ("Executable '{bin}' was not found in PATH. Current PATH:\n\n"
@@ -353,6 +596,8 @@ class Cmd(object):
 class GitCmd(GitRepoHelper, Cmd):
     executable = 'git'
     bin = ['git']
+    read_only = ('status', 'diff', 'diff-index', 'diff-files', 'log', 'show', 'blame', 'rev-parse',
+                 'rev-list', 'ls-files', 'ls-tree', 'cat-file', 'name-rev', 'describe', 'shortlog')
     opts = [
         '--no-pager',
         '-c', 'color.diff=false',
@@ -377,6 +622,126 @@ class GitCmd(GitRepoHelper, Cmd):
     def git_async(self, cmd, *args, **kwargs):
         return self.cmd_async(cmd, *args, **kwargs)
 
+    def git_stream(self, cmd, *args, **kwargs):
+        return self.cmd_stream(cmd, *args, **kwargs)
+
+    # commands on many paths at once
+    PATHSPEC_FROM_FILE = ('add', 'checkout', 'reset', 'rm', 'restore', 'stash', 'commit')
+    PATHSPEC_FROM_FILE_VERSION = (2, 26)
+    MAX_PATHS_LENGTH = 8000
+
+    def git_build(self):
+        command = tuple(self.build_command([]))
+        if command not in git_builds:
+            git_builds[command] = self.git_string(['version', '--build-options'])
+        return git_builds[command]
+
+    def git_version(self):
+        version = self.git_build().split('\n')[0]
+        numbers = re.findall(r'\d+', version.split(' ')[-1] if version else '')
+        return tuple(int(n) for n in numbers[:3]) or (0,)
+
+    # large repository mode
+    LARGE_REPO_OPTS = ['-c', 'core.untrackedCache=true', '-c', 'core.preloadIndex=true']
+    FSMONITOR_OPTS = ['-c', 'core.fsmonitor=true']
+
+    def is_large_repo(self, repo):
+        setting = get_setting('git_large_repos', False)
+        if isinstance(setting, list):
+            repo = os.path.realpath(repo)
+            return any(os.path.realpath(os.path.expanduser(r)) == repo for r in setting)
+        return setting is True
+
+    def has_fsmonitor_daemon(self):
+        # the built-in daemon came with git 2.36, on some platforms only
+        return 'fsmonitor--daemon' in self.git_build()
+
+    def repo_opts(self, cwd):
+        repo = self.first_git_repo(cwd) if cwd else None
+        if not repo or not self.is_large_repo(repo):
+            return []
+        return self.get_large_repo_opts(repo)
+
+    def get_large_repo_opts(self, repo):
+        if repo not in large_repo_opts:
+            # the git commands below get the basic options meanwhile
+            large_repo_opts[repo] = list(self.LARGE_REPO_OPTS)
+            opts = list(self.LARGE_REPO_OPTS)
+            # leave a configured fsmonitor hook or daemon alone
+            if self.has_fsmonitor_daemon() and not self.git_string(['config', 'core.fsmonitor'], cwd=repo):
+                opts += self.FSMONITOR_OPTS
+            large_repo_opts[repo] = opts
+        return large_repo_opts[repo]
+
+    def git_paths(self, cmd, paths, cwd=None, **kwargs):
+        """
+        Run a git command once on a whole list of paths, which are appended
+        after the command. Long lists are passed on stdin with
+        --pathspec-from-file when the command supports it, and split over
+        as few commands as the command line allows otherwise.
+
+        Returns (exit, stdout, stderr) of the first command that failed, or
+        of the last one run.
+        """
+        paths = list(paths)
+        if not paths:
+            return 0, '', ''
+
+        if sum(len(p) + 1 for p in paths) <= self.MAX_PATHS_LENGTH:
+            return self.git(cmd + ['--'] + paths, cwd=cwd, **kwargs)
+
+        if cmd[0] in self.PATHSPEC_FROM_FILE and self.git_version() >= self.PATHSPEC_FROM_FILE_VERSION:
+            return self.git(cmd + ['--pathspec-from-file=-', '--pathspec-file-nul'],
+                            stdin='\x00'.join(paths), cwd=cwd, **kwargs)
+
+        result = None
+        chunk, length = [], 0
+        for path in paths + [None]:
+            if chunk and (path is None or length + len(path) + 1 > self.MAX_PATHS_LENGTH):
+                chunk_result = self.git(cmd + ['--'] + chunk, cwd=cwd, **kwargs)
+                if result is None or result[0] == 0:
+                    result = chunk_result
+                chunk, length = [], 0
+            if path is not None:
+                chunk.append(path)
+                length += len(path) + 1
+        return result
+
+    # object access through a persistent git cat-file
+    def git_objects(self, repo, names, check=False):
+        """
+        Look up several objects at once. Returns a (sha, type, content)
+        tuple per name, or (sha, type, size) if check is true, and None
+        for names which do not exist.
+        """
+        reader = get_cat_file(self.build_command([]), repo, self.env(), self.startupinfo(), check)
+        try:
+            return reader.read(names)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('git cat-file failed: %s', e)
+            return [None] * len(names)
+
+    def git_object_info(self, repo, name):
+        return self.git_objects(repo, [name], check=True)[0]
+
+    def git_object(self, repo, name, encoding=None, fallback=None):
+        """
+        Read a single object, returning (type, decoded content), or
+        (None, None) if it does not exist.
+        """
+        obj = self.git_objects(repo, [name])[0]
+        if obj is None:
+            return None, None
+
+        encoding = encoding or get_setting('encoding', 'utf-8')
+        fallback = fallback or get_setting('fallback_encodings', [])
+        _, kind, data = obj
+        try:
+            return kind, self.decode(data, encoding, fallback)
+        except UnicodeDecodeError:
+            sublime.error_message(self.get_decoding_error(encoding, fallback))
+            return None, None
+
 
 class GitFlowCmd(GitRepoHelper, Cmd):
     executable = 'git_flow'
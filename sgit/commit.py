@@ -59,8 +59,9 @@ class GitCommitWindowCmd(GitCmd, GitStatusHelper):
 
         old_msg = ''
         if amend:
-            old_msg = self.git_lines(['rev-list', '--format=%B', '--max-count=1', 'HEAD'], cwd=repo)
-            old_msg = "%s\n" % "\n".join(old_msg[1:])
+            _, commit = self.git_object(repo, 'HEAD')
+            message = commit.split('\n\n', 1)[1] if commit and '\n\n' in commit else ''
+            old_msg = "%s\n" % message.rstrip()
         elif merge:
             current_branch = self.git_string(['branch', '--show-current'], cwd=repo)
             merged_branch = self.git_string(['name-rev', '--name-only', 'MERGE_HEAD'], cwd=repo)
@@ -352,4 +353,4 @@ class GitCommitUndoCommand(GitCommitWindowCmd, WindowCommand):
         if not sublime.ok_cancel_dialog(message, 'Undo commit'):
             return
 
-        self.git(['reset', 'HEAD~1'])
+        self.git(['reset', 'HEAD~1'], cwd=repo)
@@ -1,16 +1,20 @@
 # coding: utf-8
-import re
+import os
+import time
+import codecs
+import threading
+from bisect import bisect_left, bisect_right
 from functools import partial
 
 import sublime
 from sublime_plugin import WindowCommand, TextCommand, EventListener
 
-from .util import find_view_by_settings, get_setting
+from .util import find_view_by_settings, get_setting, replace_lines
 from .cmd import GitCmd
+from .worker import PRIORITY_REFRESH, PRIORITY_INTERACTIVE
+from .state import get_fingerprint, mtime
 from .helpers import GitDiffHelper, GitErrorHelper, GitStatusHelper
-
-
-RE_DIFF_HEAD = re.compile(r'(---|\+\+\+){3} (a|b)/(dev/null)?')
+from .diffparse import HunkTable, DiffParser, parse_diff
 
 
 GIT_DIFF_TITLE = '*git-diff*'
@@ -20,6 +24,13 @@ GIT_DIFF_CACHED_TITLE_PREFIX = GIT_DIFF_CACHED_TITLE + ': '
 GIT_DIFF_EDIT_HUNK_TITLE = '*git-edit-hunk*'
 GIT_DIFF_CLEAN = "Nothing to stage (no difference between working tree and index)"
 GIT_DIFF_CLEAN_CACHED = "Nothing to unstage (no changes in index)"
+GIT_DIFF_LOADING_KEY = 'git-diff-loading'
+GIT_DIFF_LOADING = "Loading diff... (%d KB)"
+GIT_DIFF_LOADING_ERROR = "The diff is still loading."
+GIT_DIFF_SUMMARY_FILE = "diff --git a/%s b/%s\n"
+GIT_DIFF_SUMMARY_CHANGES = "    +%s -%s (tab = show changes)\n"
+GIT_DIFF_SUMMARY_LARGE = "    +%s -%s, large file (tab = show changes)\n"
+GIT_DIFF_SUMMARY_BINARY = "    binary file (tab = show changes)\n"
 
 GIT_DIFF_VIEW_SYNTAX = 'Packages/SublimeGit/syntax/SublimeGit Diff.tmLanguage'
 NORMAL_DIFF_VIEW_SYNTAX = "Packages/Diff/Diff.sublime-syntax"
@@ -28,6 +39,262 @@ GIT_DIFF_UNSTAGE_ERROR = "Cannot unstage hunks which have not been staged."
 GIT_DIFF_STAGE_ERROR = "Cannot stage hunks which are already staged."
 
 
+class DiffIndex(HunkTable):
+    """
+    The hunk table of a diff view, with the file headers and hunks as
+    regions of the view.
+
+    While the diff is still coming in, the table may already know about
+    text which is not in the view yet. Only the files and hunks starting
+    before the limit are counted then.
+    """
+
+    limit = None
+
+    @property
+    def file_count(self):
+        count = len(self.header_begins)
+        if self.limit is None:
+            return count
+        return bisect_left(self.header_begins, self.limit, 0, count)
+
+    @property
+    def hunk_count(self):
+        count = len(self.hunk_begins)
+        if self.limit is None:
+            return count
+        return bisect_left(self.hunk_begins, self.limit, 0, count)
+
+    @classmethod
+    def from_text(cls, text):
+        return parse_diff(text.encode('utf-8', 'replace'), cls())
+
+    def header_region(self, f):
+        return sublime.Region(self.header_begins[f], self.header_ends[f])
+
+    def hunk_region(self, h):
+        return sublime.Region(self.hunk_begins[h], self.hunk_ends[h])
+
+    def hunks_in_region(self, region, size):
+        return self.hunks_in(region.begin(), region.end(), size)
+
+
+# diff indexes of the diff views, as (change count, index) per view id
+diff_indexes = {}
+
+# the diffs being loaded into the diff views, per view id
+diff_streams = {}
+
+# what the diff views in summary mode show, per view id
+diff_summaries = {}
+
+# diffs of single files shown in summary mode, as (fingerprint, diff)
+# per (repo, paths, cached, unified), and how many of them to keep
+file_diffs = {}
+MAX_FILE_DIFFS = 500
+
+
+class SummaryFile(object):
+    """
+    A changed file in a diff view in summary mode, shown either as its
+    numbers of added and removed lines or, once expanded, as its diff.
+    """
+
+    def __init__(self, added, deleted, path, orig=None, size=None):
+        self.added = added
+        self.deleted = deleted
+        self.path = path
+        self.orig = orig
+        self.size = size
+        self.diff = None
+
+    @property
+    def paths(self):
+        return [self.orig, self.path] if self.orig else [self.path]
+
+    @property
+    def binary(self):
+        return self.added is None
+
+    @property
+    def large(self):
+        max_lines = get_setting('git_diff_collapse_lines', 1000)
+        max_bytes = get_setting('git_diff_collapse_bytes', 1048576)
+        if max_lines and not self.binary and self.added + self.deleted > max_lines:
+            return True
+        return bool(max_bytes and self.size and self.size > max_bytes)
+
+    def render(self):
+        if self.diff is not None:
+            return self.diff
+        header = GIT_DIFF_SUMMARY_FILE % (self.orig or self.path, self.path)
+        if self.binary:
+            return header + GIT_DIFF_SUMMARY_BINARY
+        elif self.large:
+            return header + GIT_DIFF_SUMMARY_LARGE % (self.added, self.deleted)
+        return header + GIT_DIFF_SUMMARY_CHANGES % (self.added, self.deleted)
+
+
+class DiffSummary(object):
+    """
+    The files of a diff view in summary mode, with where each of them
+    begins in the view. The diff of a file is only looked up when it is
+    expanded, or when navigating to it unless it is large.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.begins = []
+        self.layout()
+
+    def layout(self):
+        self.begins = []
+        point = 0
+        for f in self.files:
+            self.begins.append(point)
+            point += len(f.render())
+
+    def render(self):
+        return ''.join(f.render() for f in self.files)
+
+    def file_at(self, point):
+        return max(0, bisect_right(self.begins, point) - 1) if self.files else None
+
+    def region(self, i):
+        return sublime.Region(self.begins[i], self.begins[i] + len(self.files[i].render()))
+
+    def lazy_files(self):
+        # the collapsed files which are expanded just by going there
+        return [i for i, f in enumerate(self.files) if f.diff is None and not f.large]
+
+
+class DiffStream(object):
+    """
+    The output of git diff on its way into a diff view.
+
+    It is parsed and decoded in the worker as it arrives, and handed to
+    the view in batches, so the hunks received so far can be looked at
+    while the rest is still loading. The encoding is picked from the
+    first chunk, the same way as for the output of other commands: the
+    configured encoding, or else the first fallback encoding which can
+    decode it. Anything the picked encoding can not decode further on
+    shows up as replacement characters.
+    """
+
+    # characters to collect, or seconds to wait, before updating the view
+    BATCH_SIZE = 262144
+    BATCH_DELAY = 0.1
+
+    def __init__(self, view, encoding, fallback=None, goto=None, on_show=None):
+        self.view = view
+        self.index = DiffIndex()
+        self.encoding = encoding
+        self.fallback = fallback or []
+        self.parser = None
+        self.decoder = None
+        self.goto = goto
+        self.cursor = None
+        self.on_show = on_show
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_size = 0
+        self.received = 0
+        self.shown = False
+        self.last_batch = time.time()
+        self.job = None
+
+    def is_current(self):
+        return diff_streams.get(self.view.id()) is self
+
+    def detect_encoding(self, data):
+        for encoding in [self.encoding] + list(self.fallback):
+            try:
+                # a character cut in two at the end is fine
+                codecs.getincrementaldecoder(encoding)().decode(data)
+                return encoding
+            except (UnicodeDecodeError, LookupError):
+                pass
+        return self.encoding
+
+    def feed(self, data):
+        # in the worker
+        if self.parser is None:
+            encoding = self.detect_encoding(data)
+            self.parser = DiffParser(self.index, encoding)
+            self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self.parser.feed(data)
+        text = self.decoder.decode(data)
+        with self.lock:
+            self.pending.append(text)
+            self.pending_size += len(text)
+            self.received += len(data)
+            due = self.pending_size >= self.BATCH_SIZE or time.time() - self.last_batch >= self.BATCH_DELAY
+            if due:
+                self.last_batch = time.time()
+        if due:
+            sublime.set_timeout(self.show, 0)
+
+    def take(self):
+        with self.lock:
+            text = ''.join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+        return text
+
+    def show(self, final=False):
+        if not self.is_current():
+            return
+        text = self.take()
+        if not text and not final:
+            return
+
+        if not self.shown:
+            # the first batch replaces the previous diff, and if it is all
+            # there is, only the lines which changed are touched
+            mode = 'update' if final else 'replace'
+        else:
+            mode = 'append'
+        if not self.shown and self.received:
+            self.view.settings().set('git_diff_clean', False)
+        if text or mode != 'append':
+            self.view.run_command('git_diff_append', {'content': text, 'mode': mode})
+        self.shown = True
+
+        self.index.limit = None if final else self.view.size()
+        if final and self.received and self.index.chars != self.view.size():
+            # the view did not take the text as it was
+            self.index = DiffIndex.from_text(self.view.substr(sublime.Region(0, self.view.size())))
+        diff_indexes[self.view.id()] = (self.view.change_count(), self.index)
+        if final:
+            self.view.erase_status(GIT_DIFF_LOADING_KEY)
+        else:
+            self.view.set_status(GIT_DIFF_LOADING_KEY, GIT_DIFF_LOADING % (self.received // 1024))
+
+        if callable(self.on_show):
+            self.on_show(self, final)
+
+    def finish(self, return_code=None):
+        if not self.is_current():
+            return
+        if self.parser is not None:
+            self.parser.close()
+            with self.lock:
+                self.pending.append(self.decoder.decode(b'', True))
+        if not self.received:
+            self.view.settings().set('git_diff_clean', True)
+            self.pending = [GIT_DIFF_CLEAN_CACHED if self.view.settings().get('git_diff_cached') else GIT_DIFF_CLEAN]
+            self.index = DiffIndex()
+        self.show(final=True)
+        del diff_streams[self.view.id()]
+
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancel()
+        if self.is_current():
+            self.view.erase_status(GIT_DIFF_LOADING_KEY)
+            del diff_streams[self.view.id()]
+
+
 class GitDiffCommand(WindowCommand, GitCmd):
     """
     Shows a diff of the entire repository in a diff view.
@@ -62,6 +329,7 @@ class GitDiffCommand(WindowCommand, GitCmd):
             view.settings().set('git_diff_path', path)
             view.settings().set('git_diff_cached', cached)
             view.settings().set('git_diff_unified', 3)
+            view.settings().set('git_diff_summary', path == repo and get_setting('git_diff_summary', False))
 
         self.window.focus_view(view)
         view.run_command('git_diff_refresh', {'path': path, 'cached': cached, 'run_move': True})
@@ -133,74 +401,110 @@ class GitDiffTextCmd(GitCmd, GitDiffHelper):
             view = self.view
             sublime.set_timeout(partial(view.show, point, True), 50)
 
-    def parse_diff(self):
-        sections = []
-        state = None
-
-        prev_file = None
-        current_file = {}
-        current_hunks = []
-
-        prev_hunk = None
-        current_hunk = None
-
-        for line in self.view.lines(sublime.Region(0, self.view.size())):
-            linetext = self.view.substr(line)
-
-            if linetext.startswith('diff --git'):
-                state = 'header'
-                # new file starts
-                if prev_file != line:
-                    if prev_file is not None:
-                        if current_hunk:
-                            current_hunks.append(current_hunk)
-                        sections.append((current_file, current_hunks))
-                    prev_file = line
-                    prev_hunk = None
-
-                current_file = line
-                current_hunks = []
-            elif state == 'header' and RE_DIFF_HEAD.match(linetext):
-                current_file = current_file.cover(line)
-            elif linetext.startswith('@@'):
-                state = 'hunk'
-                # new hunk starts
-                if prev_hunk != line:
-                    if prev_hunk is not None:
-                        current_hunks.append(current_hunk)
-                    prev_hunk = line
-
-                current_hunk = line
-            elif state == 'hunk' and linetext[0] in (' ', '-', '+'):
-                current_hunk = current_hunk.cover(line)
-            elif state == 'header':
-                current_file = current_file.cover(line)
-
-        if current_file and current_hunk:
-            current_hunks.append(current_hunk)
-            sections.append((current_file, current_hunks))
-        return sections
-
-    def build_lookup(self, parsed_diff):
-        lookup = []
-        for header, hunks in parsed_diff:
-            for h in hunks:
-                lookup.append((h, header))
-        return lookup
+    def is_loading(self):
+        if self.view.id() in diff_streams:
+            sublime.status_message(GIT_DIFF_LOADING_ERROR)
+            return True
+        return False
+
+    def get_diff_index(self):
+        """
+        The diff index of the view, as built along with its content,
+        or built from the content if that has changed since.
+        """
+        view_id = self.view.id()
+        cached = diff_indexes.get(view_id)
+        if cached and cached[0] == self.view.change_count():
+            return cached[1]
+
+        index = DiffIndex.from_text(self.view.substr(sublime.Region(0, self.view.size())))
+        diff_indexes[view_id] = (self.view.change_count(), index)
+        return index
+
+    def goto_rowcol(self, row, col):
+        line = self.view.line(self.view.text_point(row, 0))
+        self.move_to_point(self.view.text_point(row, min(col, line.end() - line.begin())))
+
+    def get_file_diff(self, repo, paths, cached, unified):
+        """
+        The diff of a single file, from the cache as long as neither the
+        index nor the file in the working tree have changed.
+        """
+        key = (repo, tuple(paths), cached, unified)
+        fingerprint = (get_fingerprint(self.get_git_dirs(repo)),
+                       None if cached else tuple(mtime(os.path.join(repo, p)) for p in paths))
+        hit = file_diffs.get(key)
+        if hit and fingerprint[0] is not None and hit[0] == fingerprint:
+            return hit[1]
+
+        diff = self.git_string(self.get_diff_args(None, cached, unified) + ['--'] + paths, cwd=repo, strip=False)
+        file_diffs.pop(key, None)
+        file_diffs[key] = (fingerprint, diff)
+        while len(file_diffs) > MAX_FILE_DIFFS:
+            del file_diffs[next(iter(file_diffs))]
+        return diff
+
+    def expand_file(self, summary, i, goto='header'):
+        repo = self.view.settings().get('git_repo')
+        cached = self.view.settings().get('git_diff_cached')
+        unified = self.view.settings().get('git_diff_unified', 3)
+        f = summary.files[i]
+        thread = self.worker_run_async(partial(self.get_file_diff, repo, f.paths, cached, unified),
+                                       on_complete=partial(self.file_expanded, summary, i, goto),
+                                       repo=repo, priority=PRIORITY_INTERACTIVE,
+                                       description="git diff (%s)" % f.path)
+        thread.start()
+
+    def file_expanded(self, summary, i, goto, diff):
+        if diff_summaries.get(self.view.id()) is not summary or summary.files[i].diff is not None:
+            return
+        if not diff:
+            # the file has not changed after all, or not anymore
+            self.view.run_command('git_diff_refresh')
+            return
+        region = summary.region(i)
+        summary.files[i].diff = diff
+        self.set_file(summary, i, region, goto)
+
+    def collapse_file(self, summary, i):
+        region = summary.region(i)
+        summary.files[i].diff = None
+        self.set_file(summary, i, region, 'header')
+
+    def set_file(self, summary, i, region, goto):
+        """
+        Show a file of the summary as it is now, in place of the given
+        region, and put the cursor on its header, first or last hunk.
+        """
+        self.view.run_command('git_diff_append', {'content': summary.files[i].render(), 'mode': 'replace',
+                                                  'begin': region.begin(), 'end': region.end()})
+        summary.layout()
+        index = DiffIndex.from_text(self.view.substr(sublime.Region(0, self.view.size())))
+        diff_indexes[self.view.id()] = (self.view.change_count(), index)
+
+        region = summary.region(i)
+        first = bisect_left(index.hunk_begins, region.begin())
+        last = bisect_left(index.hunk_begins, region.end()) - 1
+        point = region.begin()
+        if goto == 'first' and first <= last:
+            point = index.hunk_begins[first]
+        elif goto == 'last' and first <= last:
+            point = index.hunk_begins[last]
+        if goto != 'header' or not region.contains(self.view.sel()[0].begin() if self.view.sel() else 0):
+            self.move_to_point(point)
 
     def get_hunks_from_selection(self, selection):
         if not selection:
             return None
-        # parse the diff view
-        diffspec = self.parse_diff()
-        lookup = self.build_lookup(diffspec)
+        index = self.get_diff_index()
+        size = self.view.size()
 
         # find the applicable hunks
         hunks = {}
         for s in selection:
-            for hunk, header in lookup:
-                if s.intersects(hunk) or hunk.contains(s) or (s.begin() == self.view.size() and hunk.contains(s.begin() - 1)):
-                    hunks.setdefault((header.begin(), header.end()), []).append(hunk)
+            for h in index.hunks_in_region(s, size):
+                f = index.hunk_files[h]
+                hunks.setdefault((index.header_begins[f], index.header_ends[f]), []).append(index.hunk_region(h))
 
         return hunks
 
@@ -220,6 +524,7 @@ class GitDiffTextCmd(GitCmd, GitDiffHelper):
 
 
 class GitDiffRefreshCommand(TextCommand, GitDiffTextCmd):
+    priority = PRIORITY_REFRESH
 
     def is_visible(self):
         return False
@@ -236,24 +541,109 @@ class GitDiffRefreshCommand(TextCommand, GitDiffTextCmd):
         point = self.view.sel()[0].begin() if self.view.sel() else 0
         row, col = self.view.rowcol(point)
 
-        diff = self.get_diff(repo, path, cached, unified=unified)
-        clean = False
-        if not diff:
-            diff = GIT_DIFF_CLEAN_CACHED if cached else GIT_DIFF_CLEAN
-            clean = True
+        # a newer refresh replaces one which is still loading
+        previous = diff_streams.get(self.view.id())
+        if previous:
+            previous.cancel()
 
-        self.view.settings().set('git_diff_clean', clean)
-        self.view.set_read_only(False)
-        self.view.replace(edit, sublime.Region(0, self.view.size()), diff)
-        self.view.set_read_only(True)
+        if self.view.settings().get('git_diff_summary'):
+            self.refresh_summary(repo, cached, unified, (row, col), run_move)
+            return
+        diff_summaries.pop(self.view.id(), None)
+
+        stream = DiffStream(self.view, get_setting('encoding', 'utf-8'), get_setting('fallback_encodings', []),
+                            goto='move' if run_move else (row, col), on_show=self.restore_cursor)
+        diff_streams[self.view.id()] = stream
+        stream.job = self.git_stream(self.get_diff_args(path, cached, unified),
+                                     cwd=repo,
+                                     on_chunk=stream.feed,
+                                     on_complete=stream.finish,
+                                     on_exception=lambda e: stream.cancel(),
+                                     target='diff:%s' % self.view.id())
+        stream.job.start()
+
+    def restore_cursor(self, stream, final):
+        """
+        Put the cursor back where it was once the view has come that far,
+        unless it has been moved while the diff was loading.
+        """
+        if stream.goto is None:
+            return
+        current = self.view.sel()[0].begin() if self.view.sel() else 0
+        if stream.cursor is not None and stream.cursor != current:
+            stream.goto = None
+            return
 
-        if run_move:
+        if stream.goto == 'move':
+            if not final and not self.get_diff_index().hunk_count:
+                stream.cursor = current
+                return
             self.view.run_command('git_diff_move')
         else:
-            row_begin = self.view.text_point(row, 0)
-            line = self.view.line(row_begin)
-            point = self.view.text_point(row, min(col, (line.end() - line.begin())))
-            self.move_to_point(point)
+            row, col = stream.goto
+            if not final and self.view.rowcol(self.view.size())[0] <= row:
+                stream.cursor = current
+                return
+            self.goto_rowcol(row, col)
+        stream.goto = None
+
+    def refresh_summary(self, repo, cached, unified, goto, run_move):
+        # files which are expanded stay that way
+        previous = diff_summaries.get(self.view.id())
+        expanded = set(f.path for f in previous.files if f.diff) if previous else set()
+        thread = self.worker_run_async(partial(self.build_summary, repo, cached, unified, expanded),
+                                       on_complete=partial(self.show_summary, cached, goto, run_move),
+                                       repo=repo, target='diff:%s' % self.view.id(),
+                                       description="git diff --numstat (%s)" % os.path.basename(repo))
+        thread.start()
+
+    def build_summary(self, repo, cached, unified, expanded):
+        numstat = self.get_diff_numstat(repo, cached)
+        sizes = {}
+        if get_setting('git_diff_collapse_bytes', 1048576):
+            sizes = self.get_diff_sizes(repo, [path for _, _, path, _ in numstat], cached)
+
+        files = [SummaryFile(added, deleted, path, orig, sizes.get(path)) for added, deleted, path, orig in numstat]
+        for f in files:
+            if f.path in expanded:
+                f.diff = self.get_file_diff(repo, f.paths, cached, unified) or None
+        summary = DiffSummary(files)
+        text = summary.render()
+        return summary, text, DiffIndex.from_text(text)
+
+    def show_summary(self, cached, goto, run_move, built):
+        summary, text, index = built
+        if not summary.files:
+            text = GIT_DIFF_CLEAN_CACHED if cached else GIT_DIFF_CLEAN
+            index = DiffIndex()
+
+        self.view.settings().set('git_diff_clean', not summary.files)
+        self.view.run_command('git_diff_append', {'content': text, 'mode': 'update'})
+        diff_summaries[self.view.id()] = summary
+        diff_indexes[self.view.id()] = (self.view.change_count(), index)
+
+        if run_move:
+            self.view.run_command('git_diff_move', {'which': 'next', 'start': -1})
+        else:
+            self.goto_rowcol(*goto)
+
+
+class GitDiffAppendCommand(TextCommand):
+
+    def is_visible(self):
+        return False
+
+    def run(self, edit, content='', mode='append', begin=None, end=None):
+        self.view.set_read_only(False)
+        if mode == 'update':
+            replace_lines(self.view, edit, content)
+        elif mode == 'replace':
+            begin = 0 if begin is None else begin
+            end = self.view.size() if end is None else end
+            self.view.replace(edit, sublime.Region(begin, end), content)
+        else:
+            self.view.insert(edit, self.view.size(), content)
+        self.view.set_read_only(True)
 
 
 class GitDiffEventListener(EventListener):
@@ -263,6 +653,11 @@ class GitDiffEventListener(EventListener):
             view.run_command('git_diff_refresh')
 
     def on_close(self, view):
+        stream = diff_streams.get(view.id())
+        if stream:
+            stream.cancel()
+        diff_indexes.pop(view.id(), None)
+        diff_summaries.pop(view.id(), None)
         if view.settings().get('git_view') == 'edit-hunk' and view.size() > 0:
             view.sel().add(sublime.Region(0, view.size()))
             view.run_command('git_diff_stage_unstage_hunk', {'recount': True})
@@ -310,40 +705,93 @@ class GitDiffMoveCommand(TextCommand, GitDiffTextCmd):
         else:
             start = 0
 
-        file_lookup = self.parse_diff()
-        hunk_lookup = self.build_lookup(file_lookup)
-        if not hunk_lookup:
+        index = self.get_diff_index()
+        summary = diff_summaries.get(self.view.id())
+        if summary and which in ('next', 'prev') and self.move_lazily(summary, index, item, which, start):
+            return
+        if not index.hunk_count:
             return
 
-        goto = None
+        if item == 'hunk':
+            count, region, nxt, prev = index.hunk_count, index.hunk_region, index.next_hunk, index.prev_hunk
+        else:
+            count, region, nxt, prev = index.file_count, index.header_region, index.next_file, index.prev_file
+
         if which == 'first':
-            goto, _ = hunk_lookup[0]
+            goto = index.hunk_region(0)
         elif which == 'last':
-            goto, _ = hunk_lookup[-1]
+            goto = index.hunk_region(index.hunk_count - 1)
         elif which == 'next':
-            if item == 'hunk':
-                next_hunks = [(h, f) for h, f in hunk_lookup if h.begin() > start]
-                goto, _ = next_hunks[0] if next_hunks else hunk_lookup[-1]
-            else:
-                next_files = [(f, h) for f, h in file_lookup if f.begin() > start]
-                goto, _ = next_files[0] if next_files else file_lookup[-1]
+            goto = region(nxt(start))
         elif which == 'prev':
-            if item == 'hunk':
-                prev_hunks = [(h, f) for h, f in hunk_lookup if h.end() < start]
-                goto, _ = prev_hunks[-1] if prev_hunks else hunk_lookup[0]
-            else:
-                prev_files = [(f, h) for f, h in file_lookup if h[-1].end() < start]
-                goto, _ = prev_files[-1] if prev_files else file_lookup[0]
+            goto = region(prev(start))
         else:
-            if item == 'hunk':
-                goto, _ = hunk_lookup[max(0, which)] if which < len(hunk_lookup) else hunk_lookup[-1]
-            else:
-                goto, _ = file_lookup[max(0, which)] if which < len(file_lookup) else file_lookup[-1]
+            goto = region(max(0, which) if which < count else count - 1)
 
         if goto:
             self.move_to_point(goto.begin())
 
 
+    def move_lazily(self, summary, index, item, which, start):
+        """
+        In summary mode, files are moved between as listed, and hunks of
+        collapsed files count as well: the first collapsed file on the way
+        to the next or previous hunk is expanded, unless it is large, and
+        the cursor goes there once its diff is in.
+        """
+        if not summary.files:
+            return True
+
+        if item == 'file':
+            if which == 'next':
+                i = min(bisect_right(summary.begins, start), len(summary.files) - 1)
+            else:
+                i = max(0, bisect_left(summary.begins, start) - 1)
+            if summary.files[i].diff is None and not summary.files[i].large:
+                self.expand_file(summary, i, 'header')
+            self.move_to_point(summary.begins[i])
+            return True
+
+        lazy = summary.lazy_files()
+        count = index.hunk_count
+        if which == 'next':
+            h = bisect_right(index.hunk_begins, start, 0, count)
+            target = index.hunk_begins[h] if h < count else None
+            ahead = [i for i in lazy if summary.begins[i] > start]
+            if ahead and (target is None or summary.begins[ahead[0]] < target):
+                self.expand_file(summary, ahead[0], 'first')
+                return True
+        else:
+            h = bisect_left(index.hunk_ends, start, 0, count) - 1
+            target = index.hunk_begins[h] if h >= 0 else None
+            behind = [i for i in lazy if summary.region(i).end() <= start]
+            if behind and (target is None or target < summary.begins[behind[-1]]):
+                self.expand_file(summary, behind[-1], 'last')
+                return True
+        return False
+
+
+class GitDiffToggleFileCommand(TextCommand, GitDiffTextCmd):
+    """
+    Show or hide the changes of the file at the cursor, in a diff view
+    which starts out with a summary of the files.
+    """
+
+    def is_visible(self):
+        return False
+
+    def run(self, edit):
+        summary = diff_summaries.get(self.view.id())
+        if not summary or not summary.files or not self.view.sel():
+            return
+
+        i = summary.file_at(self.view.sel()[0].begin())
+        if summary.files[i].diff is None:
+            self.expand_file(summary, i, 'header')
+        else:
+            self.collapse_file(summary, i)
+
+
 class GitDiffStageUnstageHunkCommand(GitDiffTextCmd, GitErrorHelper, TextCommand):
 
     def is_visible(self):
@@ -364,6 +812,10 @@ class GitDiffStageUnstageHunkCommand(GitDiffTextCmd, GitErrorHelper, TextCommand
         if self.view.settings().get('git_diff_clean') is True:
             return
 
+        # the patch could end halfway through a hunk
+        if self.is_loading():
+            return
+
         hunks = self.get_hunks_from_selection(self.view.sel())
         if hunks:
             patch = self.create_patch(hunks)
@@ -397,6 +849,10 @@ class GitDiffDiscardHunkCommand(GitDiffTextCmd, GitErrorHelper, TextCommand):
         if self.view.settings().get('git_diff_clean') is True:
             return
 
+        # the patch could end halfway through a hunk
+        if self.is_loading():
+            return
+
         hunks = self.get_hunks_from_selection(self.view.sel())
         if not hunks:
             return
@@ -454,6 +910,10 @@ class GitDiffEditHunkCommand(GitDiffTextCmd, GitErrorHelper, TextCommand):
         if self.view.settings().get('git_diff_clean') is True:
             return
 
+        # the patch could end halfway through a hunk
+        if self.is_loading():
+            return
+
         hunks = self.get_hunks_from_selection(self.view.sel())
         if hunks:
             patch = self.create_patch(hunks)
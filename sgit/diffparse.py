@@ -0,0 +1,216 @@
+# coding: utf-8
+"""
+A streaming parser for the unified diffs git prints.
+
+It works on the raw bytes of git's output as they arrive, so it can run
+in a worker instead of on the text of a view, and it does not need
+Sublime Text, so it can be benchmarked on its own:
+
+    python sgit/diffparse.py some.patch [more.patch ...]
+"""
+import re
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+DIFF_HEAD_RE = re.compile(br'(---|\+\+\+){3} (a|b)/(dev/null)?')
+HUNK_HEAD_RE = re.compile(br'@@+ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+DIFF_GIT_RE = re.compile(br'diff --git (?:"?a/)?(.*?)"? (?:"?b/)?(.*?)"?$')
+
+try:
+    isascii = bytes.isascii
+except AttributeError:
+    isascii = None
+
+
+class HunkTable(object):
+    """
+    The files and hunks of a diff, as parallel arrays of integers.
+
+    Every file has a header, from its `diff --git` line up to its first
+    hunk, and every hunk goes from its `@@` line to its last context,
+    removed or added line. Both are given as byte offsets into git's
+    output and as character offsets into the decoded text, and end at
+    the end of their last line, excluding the newline. The end of a file
+    is the end of its last hunk, or of its header if it has none.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.header_begins = array('q')
+        self.header_ends = array('q')
+        self.header_byte_begins = array('q')
+        self.header_byte_ends = array('q')
+        self.file_ends = array('q')
+        self.file_hunks = array('q')
+
+        self.hunk_files = array('q')
+        self.old_starts = array('q')
+        self.old_counts = array('q')
+        self.new_starts = array('q')
+        self.new_counts = array('q')
+        self.hunk_begins = array('q')
+        self.hunk_ends = array('q')
+        self.hunk_byte_begins = array('q')
+        self.hunk_byte_ends = array('q')
+
+        # total bytes and characters parsed
+        self.size = 0
+        self.chars = 0
+
+    @property
+    def file_count(self):
+        return len(self.header_begins)
+
+    @property
+    def hunk_count(self):
+        return len(self.hunk_begins)
+
+    def hunks_of(self, f):
+        end = self.file_hunks[f + 1] if f + 1 < self.file_count else self.hunk_count
+        return range(self.file_hunks[f], end)
+
+    def hunks_in(self, begin, end, size):
+        """
+        Indexes of the hunks which the characters from begin to end touch.
+        A point at the very end of the text touches the hunk before it.
+        """
+        found = []
+        first = bisect_left(self.hunk_ends, begin if begin < size else begin - 1)
+        for h in range(first, bisect_right(self.hunk_begins, end)):
+            b, e = self.hunk_begins[h], self.hunk_ends[h]
+            if (b <= begin and end <= e) or (b < end and begin < e) or (begin == size and b <= begin - 1 <= e):
+                found.append(h)
+        return found
+
+    def next_hunk(self, point):
+        return min(bisect_right(self.hunk_begins, point), self.hunk_count - 1)
+
+    def prev_hunk(self, point):
+        return max(0, bisect_left(self.hunk_ends, point) - 1)
+
+    def next_file(self, point):
+        return min(bisect_right(self.header_begins, point), self.file_count - 1)
+
+    def prev_file(self, point):
+        return max(0, bisect_left(self.file_ends, point) - 1)
+
+
+class DiffParser(object):
+    """
+    Feed it git's output in chunks of any size, and it fills a hunk
+    table as complete lines come in. Character offsets assume the output
+    is decoded with the given encoding.
+    """
+
+    def __init__(self, table=None, encoding='utf-8'):
+        self.table = HunkTable() if table is None else table
+        self.encoding = encoding
+        self.pending = b''
+        self.state = None
+
+    def feed(self, data):
+        if self.pending:
+            data = self.pending + data
+        lines = data.split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.parse_line(line, 1)
+
+    def close(self):
+        if self.pending:
+            self.parse_line(self.pending, 0)
+            self.pending = b''
+        return self.table
+
+    def parse_line(self, line, newline):
+        t = self.table
+        byte_begin = t.size
+        byte_end = byte_begin + len(line)
+        begin = t.chars
+        if isascii is not None and isascii(line):
+            end = begin + len(line)
+        else:
+            end = begin + len(line.decode(self.encoding, 'replace'))
+        t.size = byte_end + newline
+        t.chars = end + newline
+
+        if line.startswith(b'diff --git'):
+            self.state = 'header'
+            match = DIFF_GIT_RE.match(line)
+            t.paths.append((match.group(2) if match else line[11:]).decode(self.encoding, 'replace'))
+            t.header_begins.append(begin)
+            t.header_ends.append(end)
+            t.header_byte_begins.append(byte_begin)
+            t.header_byte_ends.append(byte_end)
+            t.file_ends.append(end)
+            # count the arrays themselves, a subclass may limit the counts
+            # to what has been shown so far
+            t.file_hunks.append(len(t.hunk_begins))
+        elif not t.paths:
+            # anything before the first file is not part of the diff
+            pass
+        elif self.state == 'header' and DIFF_HEAD_RE.match(line):
+            t.header_ends[-1] = t.file_ends[-1] = end
+            t.header_byte_ends[-1] = byte_end
+        elif line.startswith(b'@@'):
+            self.state = 'hunk'
+            match = HUNK_HEAD_RE.match(line)
+            if match:
+                old_start, old_count, new_start, new_count = match.groups()
+                old_start, new_start = int(old_start), int(new_start)
+                old_count = 1 if old_count is None else int(old_count)
+                new_count = 1 if new_count is None else int(new_count)
+            else:
+                old_start = old_count = new_start = new_count = 0
+            t.hunk_files.append(len(t.header_begins) - 1)
+            t.old_starts.append(old_start)
+            t.old_counts.append(old_count)
+            t.new_starts.append(new_start)
+            t.new_counts.append(new_count)
+            t.hunk_begins.append(begin)
+            t.hunk_ends.append(end)
+            t.hunk_byte_begins.append(byte_begin)
+            t.hunk_byte_ends.append(byte_end)
+            t.file_ends[-1] = end
+        elif self.state == 'hunk' and line[:1] in (b' ', b'-', b'+'):
+            t.hunk_ends[-1] = t.file_ends[-1] = end
+            t.hunk_byte_ends[-1] = byte_end
+        elif self.state == 'header':
+            t.header_ends[-1] = t.file_ends[-1] = end
+            t.header_byte_ends[-1] = byte_end
+
+
+def parse_diff(data, table=None, encoding='utf-8'):
+    parser = DiffParser(table, encoding)
+    parser.feed(data)
+    return parser.close()
+
+
+def benchmark(filename, chunk_size=65536, runs=3):
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        parser = DiffParser()
+        for pos in range(0, len(data), chunk_size):
+            parser.feed(data[pos:pos + chunk_size])
+        table = parser.close()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    lines = data.count(b'\n')
+    print("%s: %d bytes, %d lines, %d files, %d hunks in %.3fs (%.0f lines/s)" % (
+        filename, len(data), lines, table.file_count, table.hunk_count, best, lines / best if best else 0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python %s some.patch [more.patch ...]" % sys.argv[0])
+        sys.exit(1)
+    for name in sys.argv[1:]:
+        benchmark(name)
@@ -29,10 +29,10 @@ class GitGitkCommand(WindowCommand, GitCmd):
 
         def async_inner():
             try:
-                os.chdir(cwd)
                 proc = subprocess.Popen(cmd,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT,
+                            cwd=cwd,
                             startupinfo=startupinfo,
                             env=environment)
                 proc.wait()
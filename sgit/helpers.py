@@ -1,10 +1,15 @@
 # coding: utf-8
 import re
 import os
+import time
 import logging
+from collections import deque
+from functools import partial
+
 import sublime
 
 from .util import get_setting
+from .state import repo_states, mtime
 
 
 logger = logging.getLogger('SublimeGit.helpers')
@@ -13,11 +18,217 @@ logger = logging.getLogger('SublimeGit.helpers')
 GIT_INIT_DIALOG = ("Could not find any git repositories based on the open files and folders. "
                    "Do you want to initialize a repository?")
 
+UNMERGED_STATES = ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU')
+
+# seconds to trust that a directory is (or is not) inside a repository,
+# after which a .git created outside of Sublime Text will be noticed
+REPO_CACHE_TTL = 30
+
+
+class StatusSnapshot(object):
+    """
+    Everything `git status --porcelain=v2 --branch --show-stash` reports
+    about a repository: branch, upstream, ahead/behind, stash count and
+    the files, split into untracked, unstaged, staged and unmerged lists
+    of (state, filename) tuples.
+
+    Paths maps every changed tracked path to its (staged, unstaged) status
+    letters as `git diff --name-status` would report them for that path
+    alone, with None for no change; renames are split into a deleted and
+    an added path.
+    """
+
+    def __init__(self):
+        self.oid = None
+        self.branch = ''
+        self.upstream = None
+        self.ahead = None
+        self.behind = None
+        self.stashes = None
+        self.rows = []
+        self.entries = []
+        self.untracked = []
+        self.unstaged = []
+        self.staged = []
+        self.unmerged = []
+        self.paths = {}
+        self.submodules = set()
+
+    @property
+    def has_head(self):
+        return self.oid is not None
+
+    @property
+    def dirty(self):
+        return bool(self.unstaged or self.staged or self.unmerged)
+
+    @property
+    def files(self):
+        return self.untracked, self.unstaged, self.staged, self.unmerged
+
+    def is_clean(self):
+        return not (self.untracked or self.unstaged or self.staged or self.unmerged)
+
+    def add(self, kind, state, path, orig=None, submodule=False):
+        """
+        Add a file as reported by git status: kind is the porcelain v2
+        line type, and orig the original path of a rename or copy.
+        """
+        self.rows.append((kind, state, path, orig, submodule))
+        if kind == '?':
+            self.entries.append(('??', path))
+            self.untracked.append(('?', path))
+            return
+
+        filename = path
+        if submodule:
+            self.submodules.add(path)
+        if orig is not None:
+            filename = "%s -> %s" % (orig, path)
+            if state[0] == 'R':
+                self.paths[orig] = ('D', None)
+
+        self.entries.append((state, filename))
+        if kind == 'u' or state in UNMERGED_STATES:
+            self.unmerged.append((state, filename))
+            self.paths[path] = ('U', 'U')
+        else:
+            index, worktree = state
+            self.paths[path] = (path_status(index), path_status(worktree))
+            if worktree != ' ':
+                self.unstaged.append((worktree, filename))
+            if index != ' ':
+                self.staged.append((index, filename))
+
+    def touched_paths(self, paths):
+        """
+        The given paths, plus both sides of any rename or copy they are
+        part of, which git only pairs up when it sees both.
+        """
+        paths = set(paths)
+        for row in self.rows:
+            if row[3] is not None and (row[2] in paths or row[3] in paths):
+                paths.update(row[2:4])
+        return paths
+
+    def updated(self, other, paths):
+        """
+        A copy of this snapshot with everything at or below the given paths
+        replaced by what another snapshot, limited to those paths, reports.
+        """
+        prefixes = tuple(p.rstrip('/') + '/' for p in paths)
+
+        def touched(path):
+            return path is not None and (path in paths or path.startswith(prefixes))
+
+        rows = [r for r in self.rows if not (touched(r[2]) or touched(r[3]))] + other.rows
+        rows.sort(key=lambda r: (r[0] == '?', r[2]))
+
+        snapshot = StatusSnapshot()
+        for attr in ('oid', 'branch', 'upstream', 'ahead', 'behind', 'stashes'):
+            setattr(snapshot, attr, getattr(other, attr))
+        for row in rows:
+            snapshot.add(*row)
+        return snapshot
+
+
+def path_status(state):
+    # the new side of a rename or copy is an added file on its own
+    if state in ('R', 'C'):
+        return 'A'
+    return None if state == ' ' else state
+
+
+def parse_porcelain_v2(output):
+    """
+    Parse the output of `git status --porcelain=v2 --branch -z`.
+    """
+    snapshot = StatusSnapshot()
+    rows = output.split('\x00')
+    idx = 0
+    while idx < len(rows):
+        row = rows[idx]
+        idx += 1
+        if not row:
+            continue
+
+        kind = row[0]
+        if kind == '#':
+            _, key, value = (row.split(' ', 2) + [''])[:3]
+            if key == 'branch.oid':
+                snapshot.oid = None if value == '(initial)' else value
+            elif key == 'branch.head':
+                snapshot.branch = '' if value == '(detached)' else value
+            elif key == 'branch.upstream':
+                snapshot.upstream = value
+            elif key == 'branch.ab':
+                ahead, behind = value.split(' ')
+                snapshot.ahead, snapshot.behind = int(ahead), -int(behind)
+            elif key == 'stash':
+                snapshot.stashes = int(value)
+        elif kind == '?':
+            snapshot.add(kind, '??', row[2:])
+        elif kind == '!':
+            continue
+        elif kind in ('1', '2', 'u'):
+            # 1 XY sub mH mI mW hH hI path
+            # 2 XY sub mH mI mW hH hI Xscore path NUL origPath
+            # u XY sub m1 m2 m3 mW h1 h2 h3 path
+            fields = {'1': 8, '2': 9, 'u': 10}[kind]
+            parts = row.split(' ', fields)
+            orig = None
+            if kind == '2':
+                orig = rows[idx]
+                idx += 1
+            snapshot.add(kind, parts[1].replace('.', ' '), parts[fields], orig, parts[2].startswith('S'))
+    return snapshot
+
+
+def parse_numstat(output):
+    """
+    Parse the output of `git diff --numstat -z` into a list of
+    (added, deleted, path, orig) tuples, in the order git reports them.
+    Added and deleted are None for binary files, and orig is the old
+    path of a rename or copy.
+    """
+    files = []
+    rows = output.split('\x00')
+    idx = 0
+    while idx < len(rows):
+        row = rows[idx]
+        idx += 1
+        if not row:
+            continue
+
+        added, deleted, path = row.split('\t', 2)
+        orig = None
+        if not path:
+            orig, path = rows[idx], rows[idx + 1]
+            idx += 2
+        added = None if added == '-' else int(added)
+        deleted = None if deleted == '-' else int(deleted)
+        files.append((added, deleted, path, orig))
+    return files
+
 
 class GitRepoHelper(object):
     # fallback repos for windows, indexed by id
     windows = {}
 
+    # repository root of each directory seen so far, as (root, checked at),
+    # and the repositories of each window, as (folders and files, repos, checked at)
+    repo_roots = {}
+    window_repos = {}
+
+    # git dir and common git dir of each repository, as (git dir, common dir)
+    git_dirs = {}
+
+    @classmethod
+    def forget_repos(cls):
+        cls.repo_roots.clear()
+        cls.window_repos.clear()
+        cls.git_dirs.clear()
+
     # working dir remake
     def get_dir_from_view(self, view=None):
         d = None
@@ -78,6 +289,17 @@ class GitRepoHelper(object):
         return os.path.exists(git_dir)
 
     def first_git_repo(self, directory):
+        # a known root only needs to be checked for still being there
+        cached = GitRepoHelper.repo_roots.get(directory)
+        if cached and time.time() - cached[1] < REPO_CACHE_TTL:
+            if cached[0] is None or self.is_git_repo(cached[0]):
+                return cached[0]
+
+        repo = self.find_first_git_repo(directory)
+        GitRepoHelper.repo_roots[directory] = (repo, time.time())
+        return repo
+
+    def find_first_git_repo(self, directory):
         # check the first directory and exit fast
         if self.is_git_repo(directory):
             return directory
@@ -94,19 +316,57 @@ class GitRepoHelper(object):
     def find_git_repos(self, directories):
         repos = set()
         for directory in directories:
-            for dirname in self.all_dirnames(directory):
-                if self.is_git_repo(dirname):
-                    repos.add(dirname)
+            # every repository the directory is in, nested ones included
+            repo = self.first_git_repo(directory)
+            while repo and repo not in repos:
+                repos.add(repo)
+                parent = os.path.dirname(repo)
+                repo = self.first_git_repo(parent) if parent != repo else None
         return repos
 
     def git_repos_from_window(self, window=None):
         repos = set()
         if window is not None:
+            # only look again when folders or files of the window change
+            key = (tuple(window.folders()), frozenset(v.file_name() for v in window.views() if v.file_name()))
+            cached = GitRepoHelper.window_repos.get(window.id())
+            if cached and cached[0] == key and time.time() - cached[2] < REPO_CACHE_TTL and \
+                    all(self.is_git_repo(r) for r in cached[1]):
+                return set(cached[1])
+
             dirs = self.get_dirs_prioritized(window)
             for repo in self.find_git_repos(dirs):
                 repos.add(repo)
+            GitRepoHelper.window_repos[window.id()] = (key, frozenset(repos), time.time())
         return repos
 
+    def get_git_dirs(self, repo):
+        """
+        The git dir and the common git dir of the repository. For worktrees
+        and submodules .git is a file pointing elsewhere, and a worktree
+        keeps its HEAD and index apart from the refs and config it shares
+        with the main repository, so ask git once and remember.
+        """
+        dirs = GitRepoHelper.git_dirs.get(repo)
+        if dirs is None:
+            lines = self.git_lines(['rev-parse', '--show-toplevel', '--git-dir', '--git-common-dir'], cwd=repo)
+            if len(lines) != 3:
+                # remembered as well, until the repositories are forgotten,
+                # so git is not asked again on every status bar update
+                logger.warning('get_git_dirs(repo=%s): could not resolve git dir', repo)
+                git_dir = os.path.join(repo, '.git')
+                dirs = (git_dir, git_dir)
+            else:
+                _, git_dir, common_dir = lines
+                dirs = (os.path.normpath(os.path.join(repo, git_dir)),
+                        os.path.normpath(os.path.join(repo, common_dir)))
+                logger.info('get_git_dirs(repo=%s): %s', repo, dirs)
+            GitRepoHelper.git_dirs[repo] = dirs
+        return dirs
+
+    def get_git_dir(self, repo):
+        return self.get_git_dirs(repo)[0]
+
     def git_repo_from_view(self, view=None):
         repo = None
         if view is not None:
@@ -224,13 +484,11 @@ class GitBranchHelper(object):
         # Convert to flat list
         return [(c, n) for n, c in branches.items()]
 
-    def has_head(self):
-        exit, _, _ = self.git(['rev-parse', 'HEAD'])
-        return exit == 0
+    def has_head(self, repo):
+        return self.git_object_info(repo, 'HEAD') is not None
 
-    def has_remote_head(self, remote):
-        exit, _, _ = self.git(['rev-parse', f'{remote}/HEAD'])
-        return exit == 0
+    def has_remote_head(self, repo, remote):
+        return self.git_object_info(repo, f'{remote}/HEAD') is not None
 
 
 class GitRemoteHelper(GitBranchHelper):
@@ -325,12 +583,18 @@ class GitErrorHelper(object):
 
 
 class GitStatusHelper(object):
+    # head line and remote url per repo, which only change rarely
+    head_lines = {}
+    remote_urls = {}
+
+    # seconds taken by the last few full git status calls per repo
+    status_times = {}
 
     def file_in_git(self, repo, filename):
         return self.git_exit_code(['ls-files', filename, '--error-unmatch'], cwd=repo) == 0
 
     def has_changes(self, repo):
-        return self.has_staged_changes(repo) or self.has_unstaged_changes(repo)
+        return self.get_repo_state(repo).dirty
 
     def has_staged_changes(self, repo):
         return self.git_exit_code(['diff', '--exit-code', '--quiet', '--cached'], cwd=repo) != 0
@@ -342,7 +606,7 @@ class GitStatusHelper(object):
         return self.git_exit_code(['diff', '--exit-code', '--quiet', '--diff-filter=U'], cwd=repo) != 0
 
     def is_merging(self, repo):
-        return os.path.exists(os.path.join(repo, '.git', 'MERGE_HEAD'))
+        return os.path.exists(os.path.join(self.get_git_dir(repo), 'MERGE_HEAD'))
 
     # def get_porcelain_status(self, repo):
     #     mode = self.get_untracked_mode()
@@ -350,43 +614,109 @@ class GitStatusHelper(object):
     #     return self.git_lines(cmd, cwd=repo)
 
     def get_porcelain_status(self, repo):
-        mode = self.get_untracked_mode()
-        cmd = ['status', '-z', ('--untracked-files=%s' % mode) if mode else None]
-
-        output = self.git_string(cmd, cwd=repo, strip=False)
-        rows = output.split('\x00')
-        lines = []
-        idx = 0
-        while idx < len(rows):
-            row = rows[idx]
-            if row and not row.startswith('#'):
-                status, filename = row[:2], row[3:]
-                if status[0] == 'R':
-                    lines.append("%s %s -> %s" % (status, rows[idx + 1], filename))
-                    idx += 1
-                else:
-                    lines.append("%s %s" % (status, filename))
-            idx += 1
-        return lines
+        return ["%s %s" % entry for entry in self.get_repo_state(repo).entries]
 
     def get_files_status(self, repo):
-        untracked, unstaged, staged, unmerged = [], [], [], []
-        status = self.get_porcelain_status(repo)
-        for l in status:
-            state, filename = l[:2], l[3:]
-            index, worktree = state
-            if state in ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU'):
-                unmerged.append((state, filename))
-            elif state == '??':
-                untracked.append(('?', filename))
-            elif state == '!!':
-                continue
-            else:
-                if worktree != ' ':
-                    unstaged.append((worktree, filename))
-                if index != ' ':
-                    staged.append((index, filename))
-        return untracked, unstaged, staged, unmerged
+        return self.get_repo_state(repo).files
+
+    def get_repo_state(self, repo, force=False):
+        """
+        The status snapshot of the repository, shared between everything
+        that needs it. Only runs git status when something has changed.
+        """
+        mode = self.get_untracked_mode()
+        return repo_states.get(repo, self.get_git_dirs(repo), partial(self.get_status_snapshot, repo),
+                               variant=mode, force=force, update=self.get_snapshot_updater(repo, mode))
+
+    def peek_repo_state(self, repo):
+        """
+        The status snapshot get_repo_state would return if it is still
+        valid, or None. Never runs git.
+        """
+        return repo_states.peek(repo, self.get_git_dirs(repo), variant=self.get_untracked_mode())
+
+    def peek_repo_probe(self, repo):
+        """
+        Any valid status snapshot of the repository, or None. Never runs git.
+        """
+        return repo_states.lookup(repo, self.get_git_dirs(repo))
+
+    def get_repo_probe(self, repo):
+        """
+        Branch, upstream and tracked changes of the repository, without
+        looking for untracked files, which is the slow part of git status
+        in large repositories. Any valid snapshot of the repository will do.
+        """
+        git_dirs = self.get_git_dirs(repo)
+        snapshot = repo_states.lookup(repo, git_dirs)
+        if snapshot is None:
+            snapshot = repo_states.get(repo, git_dirs, partial(self.get_status_snapshot, repo, untracked='no'),
+                                       variant='no', update=self.get_snapshot_updater(repo, 'no'))
+        return snapshot
+
+    def get_snapshot_updater(self, repo, mode):
+        # untracked directories are only listed file by file in these modes,
+        # so what git says about a few paths can replace what it said before
+        if mode not in ('all', 'no'):
+            return None
+
+        def update(snapshot, paths):
+            if not paths:
+                return snapshot
+            paths = snapshot.touched_paths(paths)
+            return snapshot.updated(self.get_status_snapshot(repo, untracked=mode, paths=paths), paths)
+        return update
+
+    def get_status_snapshot(self, repo, untracked=None, paths=None):
+        mode = untracked or self.get_untracked_mode()
+        cmd = ['status', '--porcelain=v2', '--branch', '-z', '--show-stash',
+               ('--untracked-files=%s' % mode) if mode else None]
+        if paths is not None:
+            cmd += ['--'] + [':(literal)%s' % p for p in sorted(paths)]
+
+        start = time.time()
+        output = self.git_string(cmd, cwd=repo, strip=False)
+        if paths is None:
+            self.status_times.setdefault(repo, deque(maxlen=20)).append(time.time() - start)
+
+        snapshot = parse_porcelain_v2(output)
+        if snapshot.stashes is None:
+            # git only reports stashes when there are any, and versions
+            # before 2.35 never do, so make sure there really are none
+            snapshot.stashes = 0 if self.git_object_info(repo, 'refs/stash') is None else None
+        return snapshot
+
+    def get_head_line(self, repo, oid):
+        """
+        The abbreviated sha and subject of the given commit, as shown by
+        `git log --oneline`, including the trailing newline. Only asks
+        git when the commit changes.
+        """
+        cached = self.head_lines.get(repo)
+        if cached and cached[0] == oid:
+            return cached[1]
+        _, line, _ = self.git(['log', '--max-count=1', '--abbrev-commit', '--pretty=oneline', oid], cwd=repo)
+        self.head_lines[repo] = (oid, line)
+        return line
+
+    def get_upstream_remote(self, repo, branch, upstream):
+        """
+        The remote name and url for the upstream of the given branch.
+        Only asks git when the branch or upstream changes.
+        """
+        try:
+            config_mtime = os.path.getmtime(os.path.join(self.get_git_dirs(repo)[1], 'config'))
+        except OSError:
+            config_mtime = None
+
+        key = (branch, upstream, config_mtime)
+        cached = self.remote_urls.get(repo)
+        if cached and cached[0] == key:
+            return cached[1]
+        remote = self.git_string(['config', 'branch.%s.remote' % branch], cwd=repo)
+        url = self.git_string(['config', 'remote.%s.url' % remote], cwd=repo) if remote else ''
+        self.remote_urls[repo] = (key, (remote, url))
+        return remote, url
 
     def get_untracked_mode(self):
         # get untracked files mode
@@ -402,7 +732,7 @@ class GitStatusHelper(object):
 
 class GitDiffHelper(object):
 
-    def get_diff(self, repo, path=None, cached=False, unified=None):
+    def get_diff_args(self, path=None, cached=False, unified=None):
         try:
             unified = int(unified)
         except:
@@ -412,12 +742,42 @@ class GitDiffHelper(object):
                 '--unified=%s' % unified if unified else None]
         if path:
             args.extend(['--', path])
-        return self.git_string(args, cwd=repo, strip=False)
+        return args
+
+    def get_diff_numstat(self, repo, cached=False):
+        output = self.git_string(['diff', '--cached' if cached else None, '--numstat', '-z'], cwd=repo, strip=False)
+        return parse_numstat(output)
+
+    def get_diff_sizes(self, repo, paths, cached=False):
+        """
+        The size in bytes of the new side of each path: the index version
+        for cached diffs, and the file in the working tree otherwise, or
+        None if there is none.
+        """
+        sizes = {}
+        lookup = []
+        for path in paths:
+            st = None if cached else mtime(os.path.join(repo, path))
+            if st is not None:
+                sizes[path] = st[1]
+            else:
+                lookup.append(path)
+        if lookup:
+            infos = self.git_objects(repo, [':' + p for p in lookup], check=True)
+            for path, info in zip(lookup, infos):
+                sizes[path] = info[2] if info else None
+        return sizes
 
 
 class GitShowHelper(object):
 
     def get_show(self, repo, obj):
+        # blobs are shown as-is, so they can be read without a new process
+        info = self.git_object_info(repo, obj)
+        if info and info[1] == 'blob':
+            _, content = self.git_object(repo, info[0])
+            if content is not None:
+                return content
         return self.git_string(['show', '--format=medium', '--no-color', obj], cwd=repo)
 
 
@@ -0,0 +1,48 @@
+# coding: utf-8
+import sublime
+from sublime_plugin import WindowCommand
+
+from .worker import scheduler
+
+
+GIT_NO_JOBS = "No git operations are running"
+GIT_CANCEL_ALL = "+ Cancel all"
+
+
+class GitCancelOperationsCommand(WindowCommand):
+    """
+    Cancel running or queued git operations.
+
+    Lists all git operations which are currently running or waiting to
+    run, along with how long they have been running or waiting. Selecting
+    an operation cancels it: a queued operation is removed from the queue,
+    and a running operation has its git process terminated. Nothing that
+    was supposed to happen after the operation will happen.
+
+    The last option in the list, **+ Cancel all**, cancels everything.
+    """
+
+    def run(self):
+        jobs = scheduler.jobs()
+        if not jobs:
+            sublime.status_message(GIT_NO_JOBS)
+            return
+
+        choices = [self.format_job(j) for j in jobs]
+        if len(jobs) > 1:
+            choices.append([GIT_CANCEL_ALL, "Cancel %s operations" % len(jobs)])
+
+        def on_done(idx):
+            if idx == -1:
+                return
+            selected = jobs if idx == len(jobs) else [jobs[idx]]
+            for job in selected:
+                scheduler.cancel(job)
+            sublime.status_message("Cancelled %s" % (selected[0].description if len(selected) == 1 else
+                                                     "%s git operations" % len(selected)))
+
+        self.window.show_quick_panel(choices, on_done)
+
+    def format_job(self, job):
+        state = "running" if job.running else "queued"
+        return [job.description, "%s for %.1fs" % (state, job.elapsed())]
@@ -368,7 +368,7 @@ class GitPushCommand(WindowCommand, GitCmd, GitRemoteHelper):
                 self.window.run_command('git_publish_current_branch')
             return
 
-        if self.has_head() and self.has_remote_head(branch_remote):
+        if self.has_head(repo) and self.has_remote_head(repo, branch_remote):
             remote_ahead, _ = self.get_remote_commit_differences(repo, branch_remote, branch)
             logger.warning('{}'.format(remote_ahead))
             if remote_ahead != 0:
@@ -84,6 +84,7 @@ class GitInitCommand(WindowCommand, GitCmd):
             return
 
         output = self.git_string(['init'], cwd=directory)
+        self.forget_repos()
         panel = self.window.get_output_panel('git-init')
         panel.run_command('git_panel_write', {'content': output})
         self.window.run_command('show_panel', {'panel': 'output.git-init'})
@@ -29,10 +29,10 @@ class GitShowCommand(WindowCommand, GitCmd):
 
     def show(self, repo, obj=None):
         if not obj:
-            exit, obj, _ = self.git(['rev-parse', 'HEAD'], cwd=repo)
-            if exit != 0:
+            info = self.git_object_info(repo, 'HEAD')
+            if not info:
                 return sublime.error_message("Nothing committed (yet)")
-            obj = obj.strip()
+            obj = info[0]
 
         title = GIT_SHOW_TITLE_PREFIX + obj[:7] if len(obj) == 40 else obj
         view = find_view_by_settings(self.window, git_view='show', git_repo=repo, git_show_obj=obj)
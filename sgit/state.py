@@ -0,0 +1,200 @@
+# coding: utf-8
+import os
+import time
+import logging
+import threading
+
+from .util import get_setting
+
+
+logger = logging.getLogger('SublimeGit.state')
+
+
+# files and directories whose modification times change whenever git
+# changes the index, HEAD, branches, stashes or config. Worktrees have
+# their own git dir for the first, and share the common dir for the rest.
+GIT_DIR_FILES = ('index', 'HEAD', 'MERGE_HEAD', os.path.join('logs', 'HEAD'))
+COMMON_DIR_FILES = ('packed-refs', 'config', os.path.join('refs', 'stash'))
+COMMON_DIR_DIRS = (os.path.join('refs', 'heads'), os.path.join('refs', 'remotes'))
+
+
+def mtime(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+
+def get_fingerprint(git_dirs):
+    """
+    The modification times of everything in the git dirs that describes
+    the state of the repository, or None if that can not be determined.
+    """
+    git_dir, common_dir = git_dirs
+    if not os.path.isdir(git_dir):
+        return None
+
+    fingerprint = [mtime(os.path.join(git_dir, f)) for f in GIT_DIR_FILES]
+    fingerprint += [mtime(os.path.join(common_dir, f)) for f in COMMON_DIR_FILES]
+    for d in COMMON_DIR_DIRS:
+        # loose refs are replaced by renaming, which touches their directory
+        for root, dirs, _ in os.walk(os.path.join(common_dir, d)):
+            fingerprint.append((root, mtime(root)))
+    return tuple(fingerprint)
+
+
+class RepoStateCache(object):
+    """
+    The last known status snapshot of each repository.
+
+    A snapshot stays valid as long as nothing in the git dir has changed,
+    no file in the repository has been saved from Sublime Text, and no
+    git command has been run from Sublime Text since it was taken. Checking
+    this takes a few calls to stat, so every consumer can ask for the state
+    of a repository as often as it likes.
+
+    Every invalidation is remembered along with the paths it concerns, if
+    known. When only a few files have changed since a snapshot was taken,
+    it can be brought up to date by asking git about just those files.
+    """
+
+    # how many invalidations to remember per repository, and how many
+    # changed paths are still worth updating a snapshot for
+    MAX_CHANGES = 64
+    MAX_CHANGED_PATHS = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generations = {}
+        self.changes = {}
+        self.touched = {}
+
+    def lookup(self, repo, git_dirs):
+        """
+        Any snapshot of the repository which is still valid, or None.
+        """
+        generation = self.generations.get(repo, 0)
+        fingerprint = get_fingerprint(git_dirs)
+        if fingerprint is None:
+            return None
+
+        with self.lock:
+            entries = [e for (r, _), e in self.entries.items() if r == repo]
+        for entry in entries:
+            if self.is_fresh(entry, fingerprint, generation):
+                return entry[2]
+
+    def peek(self, repo, git_dirs, variant=None):
+        """
+        The snapshot get() would return without running anything, or None.
+        """
+        generation = self.generations.get(repo, 0)
+        fingerprint = get_fingerprint(git_dirs)
+
+        with self.lock:
+            entry = self.entries.get((repo, variant))
+        if entry and fingerprint is not None and self.is_fresh(entry, fingerprint, generation):
+            return entry[2]
+
+    def get(self, repo, git_dirs, compute, variant=None, force=False, update=None):
+        """
+        The snapshot of the repository, from the cache if it is still
+        valid. Otherwise it is computed, or, if only a few paths have
+        changed and an update function is given, computed by calling
+        update(old snapshot, changed paths).
+        """
+        key = (repo, variant)
+        generation = self.generations.get(repo, 0)
+
+        snapshot = None if force else self.peek(repo, git_dirs, variant)
+        if snapshot is not None:
+            logger.debug('state cache hit: %s', key)
+            return snapshot
+
+        paths = None
+        if not force and update:
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry and self.is_fresh(entry, get_fingerprint(git_dirs), entry[1]):
+                paths = self.changed_paths(repo, entry[1], generation)
+
+        if paths is not None:
+            logger.debug('state cache update: %s, %s paths', key, len(paths))
+            snapshot = update(entry[2], paths)
+        else:
+            logger.debug('state cache miss: %s', key)
+            snapshot = compute()
+
+        # git status refreshes the index, so look again afterwards
+        fingerprint = get_fingerprint(git_dirs)
+        with self.lock:
+            self.entries[key] = (fingerprint, generation, snapshot, time.time())
+        return snapshot
+
+    def is_fresh(self, entry, fingerprint, generation):
+        if entry[0] != fingerprint or entry[1] != generation:
+            return False
+        max_age = get_setting('git_state_cache_max_age', None)
+        return not max_age or time.time() - entry[3] < max_age
+
+    def changed_paths(self, repo, since, until):
+        """
+        The repository relative paths which have changed between two
+        generations, or None if anything might have changed.
+        """
+        with self.lock:
+            changes = [c for c in self.changes.get(repo, []) if since < c[0] <= until]
+        if len(changes) != until - since:
+            return None
+
+        paths = set()
+        for _, changed in changes:
+            if changed is None:
+                return None
+            paths.update(changed)
+        return paths if len(paths) <= self.MAX_CHANGED_PATHS else None
+
+    def touch(self, repo, paths=None):
+        """
+        Forget the state of a repository because the given repository
+        relative paths, or anything if None, have changed.
+        """
+        with self.lock:
+            generation = self.generations.get(repo, 0) + 1
+            self.generations[repo] = generation
+            changes = self.changes.setdefault(repo, [])
+            changes.append((generation, None if paths is None else frozenset(paths)))
+            del changes[:-self.MAX_CHANGES]
+            self.touched[os.path.realpath(repo)] = time.time()
+
+    def touched_at(self, repo):
+        """
+        When the state of a repository was last forgotten, or 0 if never.
+        """
+        with self.lock:
+            return self.touched.get(os.path.realpath(repo), 0)
+
+    def invalidate(self, path, everything=True):
+        """
+        Forget the state of every repository containing the given path.
+        Unless told otherwise, anything in them may have changed.
+        """
+        path = os.path.realpath(path)
+        with self.lock:
+            repos = set(repo for repo, _ in self.entries)
+        for repo in repos:
+            root = os.path.realpath(repo)
+            if path == root:
+                self.touch(repo)
+            elif path.startswith(root.rstrip(os.sep) + os.sep):
+                changed = os.path.relpath(path, root).replace(os.sep, '/')
+                self.touch(repo, None if everything else [changed])
+
+
+repo_states = RepoStateCache()
+
+
+def file_saved(filename):
+    repo_states.invalidate(filename, everything=False)
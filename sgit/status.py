@@ -1,14 +1,21 @@
 # coding: utf-8
 import os
+import re
+import time
 import logging
 import threading
+from bisect import bisect_left, bisect_right
 from functools import partial
 
 import sublime
 from sublime_plugin import WindowCommand, TextCommand, EventListener
 
-from .util import abbreviate_dir, find_view_by_settings, noop, get_setting, get_executable
+from .util import (abbreviate_dir, find_view_by_settings, noop, get_setting, get_executable, replace_lines,
+                   StatusSpinner)
 from .cmd import GitCmd
+from .worker import PRIORITY_REFRESH, PRIORITY_BACKGROUND
+from .state import file_saved
+from .watcher import watch_repo, unwatch_repo
 from .helpers import GitStatusHelper, GitRemoteHelper, GitStashHelper, GitErrorHelper
 
 
@@ -24,6 +31,8 @@ GIT_STATUS_VIEW_SETTINGS = {
     'word_wrap': False,
     'git_status': True,
 }
+GIT_STATUS_REFRESHING_KEY = 'git-status-refreshing'
+GIT_STATUS_REFRESHING = 'Refreshing git status...'
 
 STASHES = "stashes"
 UNTRACKED_FILES = "untracked_files"
@@ -53,6 +62,30 @@ SECTION_ORDER = (
 
 SECTION_SELECTOR_PREFIX = 'meta.git-status.'
 
+# the section each header belongs to, as scoped by the syntax definition,
+# which puts "Changes:" and "Unmerged changes:" in the unstaged changes
+SECTION_HEADERS = {
+    SECTIONS[STASHES]: STASHES,
+    SECTIONS[UNTRACKED_FILES]: UNTRACKED_FILES,
+    SECTIONS[UNSTAGED_CHANGES]: UNSTAGED_CHANGES,
+    SECTIONS[CHANGES]: UNSTAGED_CHANGES,
+    SECTIONS[UNMERGED_CHANGES]: UNSTAGED_CHANGES,
+    SECTIONS[STAGED_CHANGES]: STAGED_CHANGES,
+}
+
+# the lines of each section, as matched by the syntax definition
+STASH_LINE_RE = re.compile(r'\t(.+): (?:WIP )?[oO]n (.+): (.+)\n')
+UNTRACKED_LINE_RE = re.compile(r'\t(.+)\n')
+CHANGE_LINE_RE = re.compile(r'\t([\w\-]+) *(.+)\n')
+SECTION_LINE_RE = {
+    STASHES: STASH_LINE_RE,
+    UNTRACKED_FILES: UNTRACKED_LINE_RE,
+    UNSTAGED_CHANGES: CHANGE_LINE_RE,
+    STAGED_CHANGES: CHANGE_LINE_RE,
+}
+
+HELP_START = '# Movement:\n'
+
 STATUS_LABELS = {
     ' ' : 'Unmodified',
     'M' : 'Modified  ',
@@ -73,10 +106,201 @@ STATUS_LABELS = {
     'UU': 'Modified-by-Both',
 }
 
+# files listed with both their old and new path, as "old -> new"
+PATH_PAIR_LABELS = (STATUS_LABELS['R'], STATUS_LABELS['C'])
+
 GIT_WORKING_DIR_CLEAN = "Nothing to commit (working directory clean)"
+GIT_STATUS_COLLAPSED = "    ... and %s more (tab = show all)\n"
 GIT_MERGE_IN_PROGRESS_UNMERGED = "Merge in progress (fix conflicts or abort)"
 GIT_MERGE_IN_PROGRESS_READY = "Merge in progress (all conflicts resolved; commit to finish merge)"
 
+class StatusItem(object):
+    """
+    A stash or file line of the status view. The line spans begin to end,
+    not including the newline, and the stash or file name spans
+    name_begin to name_end.
+    """
+
+    __slots__ = ('kind', 'section', 'begin', 'end', 'name_begin', 'name_end', 'name', 'text')
+
+    def __init__(self, kind, section, begin, end, name_begin, name, text):
+        self.kind = kind
+        self.section = section
+        self.begin = begin
+        self.end = end
+        self.name_begin = name_begin
+        self.name_end = name_begin + len(name)
+        self.name = name
+        self.text = text
+
+    @classmethod
+    def from_line(cls, section, begin, line):
+        """
+        The item on a line of a section starting at begin, if any.
+        """
+        match = SECTION_LINE_RE[section].match(line)
+        if match:
+            kind = 'stash' if section == STASHES else 'file'
+            group = 1 if section in (STASHES, UNTRACKED_FILES) else 2
+            return cls(kind, section, begin, begin + len(line) - 1, begin + match.start(group),
+                       match.group(group), line.strip())
+
+    @property
+    def line(self):
+        return sublime.Region(self.begin, self.end)
+
+    @property
+    def region(self):
+        return sublime.Region(self.name_begin, self.name_end)
+
+
+class StatusIndex(object):
+    """
+    Where the sections, stashes and files are in a status view, sorted by
+    position, so that they can be looked up by bisection instead of by
+    scanning the view for scopes.
+    """
+
+    def __init__(self):
+        # (header begin, header end, section end, section) per section
+        self.sections = []
+        self.section_begins = []
+        self.items = []
+        self.item_begins = []
+        self.item_ends = []
+        self.files = []
+        self.file_begins = []
+        self.file_ends = []
+        self.stashes = []
+        # (section, filename) of files in collapsed sections, not in the view
+        self.hidden = []
+
+    def add_section(self, begin, header_end, end, section):
+        self.sections.append((begin, header_end, end, section))
+        self.section_begins.append(begin)
+
+    def add_item(self, item):
+        self.items.append(item)
+        self.item_begins.append(item.begin)
+        self.item_ends.append(item.end)
+        if item.kind == 'file':
+            self.files.append(item)
+            self.file_begins.append(item.begin)
+            self.file_ends.append(item.end)
+        else:
+            self.stashes.append(item)
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Index a rendered status the same way the syntax definition scopes it.
+        """
+        index = cls()
+        section = None
+        offset = 0
+        for line in text.splitlines(True):
+            begin, offset = offset, offset + len(line)
+            if section is None:
+                if line == HELP_START:
+                    # the rest is help text
+                    break
+                if line in SECTION_HEADERS:
+                    section = [begin, offset, SECTION_HEADERS[line], []]
+                continue
+
+            if line == '\n':
+                index.add_section_items(section, offset)
+                section = None
+                continue
+
+            item = StatusItem.from_line(section[2], begin, line)
+            if item:
+                section[3].append(item)
+        if section is not None:
+            index.add_section_items(section, offset)
+        return index
+
+    def add_section_items(self, section, end):
+        begin, header_end, name, items = section
+        self.add_section(begin, header_end, end, name)
+        for item in items:
+            self.add_item(item)
+
+    # lookups
+    def section_at(self, point):
+        idx = bisect_right(self.section_begins, point) - 1
+        if idx >= 0 and point < self.sections[idx][2]:
+            return self.sections[idx][3]
+
+    def header_regions(self):
+        return [sublime.Region(b, e) for b, e, _, _ in self.sections]
+
+    def items_in(self, begin, end):
+        """All items on lines overlapping begin to end."""
+        return self.items[bisect_left(self.item_ends, begin):bisect_right(self.item_begins, end)]
+
+    def next_or_prev(self, direction, begins, ends, point):
+        """
+        The index of the first line starting after point, or the last one
+        ending before it, wrapping around at the ends.
+        """
+        if direction == 'next':
+            idx = bisect_right(begins, point)
+            return idx if idx < len(begins) else 0
+        else:
+            idx = bisect_left(ends, point) - 1
+            return idx if idx >= 0 else len(ends) - 1
+
+
+class StatusWriter(object):
+    """
+    Collects the text of a status as a list of parts, and indexes its
+    sections and items as they are written, so that building a status
+    takes time and memory linear in its size.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.offset = 0
+        self.index = StatusIndex()
+        self.section = None
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+    def write(self, text):
+        self.parts.append(text)
+        self.offset += len(text)
+
+    def header(self, section):
+        begin = self.offset
+        self.write(SECTIONS[section])
+        self.section = [begin, self.offset, SECTION_HEADERS[SECTIONS[section]], []]
+
+    def line(self, text):
+        if self.section is not None:
+            item = StatusItem.from_line(self.section[2], self.offset, text)
+            if item:
+                self.section[3].append(item)
+        self.write(text)
+
+    def blank(self):
+        # an empty line ends the current section
+        self.write("\n")
+        if self.section is not None:
+            self.index.add_section_items(self.section, self.offset)
+            self.section = None
+
+
+# status indexes of the status views, as (change count, index) per view id,
+# and indexes built along with a status, as (status, index) per view id
+status_indexes = {}
+built_indexes = {}
+
+# what each status view shows, as (snapshot, expanded sections, status) per view id
+rendered_status = {}
+
+
 GIT_STATUS_HELP = """
 # Movement:
 #    r = refresh status
@@ -102,6 +326,7 @@ GIT_STATUS_HELP = """
 #    i = ignore file, I = ignore pattern
 #    enter = open file
 #    d = view diff
+#    tab = show all/fewer files of a large section
 #
 # Stashes:
 #    a = apply stash, A = pop stash
@@ -111,102 +336,125 @@ GIT_STATUS_HELP = """
 
 class GitStatusBuilder(GitCmd, GitStatusHelper, GitRemoteHelper, GitStashHelper):
 
-    def build_status(self, repo):
-        branch = self.get_current_branch(repo)
-        remote = self.get_branch_remote(repo, branch)
-        remote_url = self.get_remote_url(repo, remote)
+    def build_status(self, repo, force=True, expanded=()):
+        return self.render_status(repo, force, expanded).getvalue()
 
-        abbrev_dir = abbreviate_dir(repo)
+    def build_status_and_index(self, repo, force=True, expanded=()):
+        out = self.render_status(repo, force, expanded)
+        return out.getvalue(), out.index
+
+    def render_status(self, repo, force=True, expanded=(), snapshot=None):
+        # git status refreshes the index by itself, and reports branch,
+        # upstream, stashes and files all at once. The status view asks
+        # git unless told otherwise, and shares what it finds with
+        # everything else.
+        if snapshot is None:
+            snapshot = self.get_repo_state(repo, force=force)
+        branch = snapshot.branch
 
-        head_rc, head, _ = self.git(['log', '--max-count=1', '--abbrev-commit', '--pretty=oneline'], cwd=repo)
+        abbrev_dir = abbreviate_dir(repo)
 
-        status = ""
-        if remote and self.has_head() and self.has_remote_head(remote):
-            status += "Remote:\t%s/%s @ %s\n" % (remote, branch, remote_url)
-            remote_ahead, local_ahead = self.get_remote_commit_differences(repo, remote, branch)
+        out = StatusWriter()
+        if snapshot.has_head and snapshot.upstream and snapshot.ahead is not None:
+            remote, remote_url = self.get_upstream_remote(repo, branch, snapshot.upstream)
+            out.write("Remote:\t%s @ %s\n" % (snapshot.upstream, remote_url))
+            local_ahead, remote_ahead = snapshot.ahead, snapshot.behind
             if local_ahead != 0 and remote_ahead != 0:
-                status += "\t\tYour branch and %s/%s have diverged,\n" \
-                            % (remote, branch)
-                status += "\t\tand have %s and %s different commit each, " \
-                            "respectively\n" % (local_ahead, remote_ahead)
+                out.write("\t\tYour branch and %s have diverged,\n"
+                          % (snapshot.upstream))
+                out.write("\t\tand have %s and %s different commit each, "
+                          "respectively\n" % (local_ahead, remote_ahead))
             elif local_ahead != 0:
-                status += "\t\tYour branch is ahead by %s commits\n" \
-                            % (local_ahead)
+                out.write("\t\tYour branch is ahead by %s commits\n"
+                          % (local_ahead))
             elif remote_ahead != 0:
-                status += "\t\tRemote branch is ahead by %s commits\n" \
-                            % (remote_ahead)
-        status += "Local:\t%s %s\n" % (branch if branch else '(no branch)', abbrev_dir)
-        status += "Head:\t%s\n" % ("nothing committed (yet)" if head_rc != 0 else head)
-        status += "\n"
-
-        # update index
-        self.git_exit_code(['update-index', '--refresh'], cwd=repo)
+                out.write("\t\tRemote branch is ahead by %s commits\n"
+                          % (remote_ahead))
+        out.write("Local:\t%s %s\n" % (branch if branch else '(no branch)', abbrev_dir))
+        out.write("Head:\t%s\n" % (self.get_head_line(repo, snapshot.oid) if snapshot.has_head else "nothing committed (yet)"))
+        out.blank()
 
-        status += self.build_stashes(repo)
-        status += self.build_files_status(repo)
+        self.build_stashes(repo, snapshot, out)
+        self.build_files_status(repo, snapshot, expanded, out)
 
         if get_setting('git_show_status_help', True):
-            status += GIT_STATUS_HELP
-
-        return status
+            out.write(GIT_STATUS_HELP)
 
-    def build_stashes(self, repo):
-        status = ""
+        return out
 
-        stashes = self.get_stashes(repo)
+    def build_stashes(self, repo, snapshot, out):
+        # only list stashes when there are any, or we can not tell
+        stashes = self.get_stashes(repo) if snapshot.stashes != 0 else []
         if stashes:
-            status += SECTIONS[STASHES]
+            out.header(STASHES)
             for name, title in stashes:
-                status += "\t%s: %s\n" % (name, title)
-            status += "\n"
-
-        return status
+                out.line("\t%s: %s\n" % (name, title))
+            out.blank()
+
+    def collapse_files(self, section, files, expanded, out):
+        """
+        The files of a section which should be shown. Only the first few
+        files of a large section are shown, unless it has been expanded,
+        and the rest are only added to the index.
+        """
+        threshold = get_setting('git_status_collapse_threshold', 1000)
+        if not threshold or section in expanded or len(files) <= threshold:
+            return files, 0
+
+        shown = max(0, min(get_setting('git_status_collapsed_files', 100), threshold))
+        index_section = SECTION_HEADERS[SECTIONS[section]]
+        for s, f in files[shown:]:
+            out.index.hidden.extend((index_section, name) for name in split_paths(s, f.strip()))
+        return files[:shown], len(files) - shown
+
+    def build_files_section(self, section, files, expanded, out):
+        out.header(section)
+        files, more = self.collapse_files(section, files, expanded, out)
+        for s, f in files:
+            if section == UNTRACKED_FILES:
+                out.line("\t%s\n" % f.strip())
+            else:
+                out.line("\t%s %s\n" % (STATUS_LABELS[s], f))
+        if more:
+            out.line(GIT_STATUS_COLLAPSED % more)
 
-    def build_files_status(self, repo):
-        # get status
-        status = ""
-        untracked, unstaged, staged, unmerged = self.get_files_status(repo)
+    def build_files_status(self, repo, snapshot, expanded, out):
+        start = out.offset
+        untracked, unstaged, staged, unmerged = snapshot.files
 
         if not untracked and not unstaged and not staged and not unmerged:
-            status += GIT_WORKING_DIR_CLEAN + "\n"
+            out.write(GIT_WORKING_DIR_CLEAN + "\n")
 
         if self.is_merging(repo):
             if not unmerged:
-                status += GIT_MERGE_IN_PROGRESS_READY + "\n"
+                out.write(GIT_MERGE_IN_PROGRESS_READY + "\n")
             else:
-                status += GIT_MERGE_IN_PROGRESS_UNMERGED + "\n"
-
-        # untracked files
-        if untracked:
-            status += "\n" if len(status) != 0 else ""
-            status += SECTIONS[UNTRACKED_FILES]
-            for s, f in untracked:
-                status += "\t%s\n" % f.strip()
-
-        # unstaged changes
-        if unstaged:
-            status += "\n" if len(status) != 0 else ""
-            status += SECTIONS[UNSTAGED_CHANGES] if staged else SECTIONS[CHANGES]
-            for s, f in unstaged:
-                status += "\t%s %s\n" % (STATUS_LABELS[s], f)
-
-        # unmerged files
-        if unmerged:
-            status += "\n" if len(status) != 0 else ""
-            status += SECTIONS[UNMERGED_CHANGES]
-            for s, f in unmerged:
-                status += "\t%s %s\n" % (STATUS_LABELS[s], f)
+                out.write(GIT_MERGE_IN_PROGRESS_UNMERGED + "\n")
+
+        sections = (
+            (UNTRACKED_FILES, untracked),
+            (UNSTAGED_CHANGES if staged else CHANGES, unstaged),
+            (UNMERGED_CHANGES, unmerged),
+            (STAGED_CHANGES, staged),
+        )
+        for section, files in sections:
+            if files:
+                # sections are separated by an empty line
+                if out.offset != start:
+                    out.blank()
+                self.build_files_section(section, files, expanded, out)
 
-        # staged changes
-        if staged:
-            status += "\n" if len(status) != 0 else ""
-            status += SECTIONS[STAGED_CHANGES]
-            for s, f in staged:
-                status += "\t%s %s\n" % (STATUS_LABELS[s], f)
+        out.blank()
 
-        status += "\n"
 
-        return status
+def split_paths(state, name):
+    """
+    The paths of a file as listed in the status view: both the old and
+    the new path of a rename or copy, shown as "old -> new".
+    """
+    if state in ('R', 'C') and ' -> ' in name:
+        return name.split(' -> ', 1)
+    return [name]
 
 
 class GitStatusTextCmd(GitCmd):
@@ -228,70 +476,76 @@ class GitStatusTextCmd(GitCmd):
         sels = self.view.sel()
         return [s.begin() for s in sels]
 
+    # status index
+    def get_status_index(self):
+        """
+        The index of the status view, which is built along with the status,
+        or from the view itself if the view has changed since then.
+        """
+        change_count = self.view.change_count()
+        cached = status_indexes.get(self.view.id())
+        if cached and cached[0] == change_count:
+            return cached[1]
+
+        index = StatusIndex.from_text(self.view.substr(sublime.Region(0, self.view.size())))
+        status_indexes[self.view.id()] = (change_count, index)
+        return index
+
+    def get_selected_items(self):
+        index = self.get_status_index()
+        items = []
+        seen = set()
+        for selection in self.view.sel():
+            begin = self.view.line(selection.begin()).begin()
+            end = self.view.line(selection.end()).end()
+            for item in index.items_in(begin, end):
+                if item.begin not in seen:
+                    seen.add(item.begin)
+                    items.append(item)
+        return items
+
     # line helpers
     def get_selected_lines(self):
-        sels = self.view.sel()
-        selected_lines = []
-        for selection in sels:
-            lines = self.view.lines(selection)
-            for line in lines:
-                if self.view.score_selector(line.begin(), 'meta.git-status.line') > 0:
-                    selected_lines.append(line)
-        return selected_lines
+        return [item.line for item in self.get_selected_items()]
 
     # stash helpers
     def get_all_stash_regions(self):
-        return self.view.find_by_selector('meta.git-status.stash.name')
+        return [i.region for i in self.get_status_index().stashes]
 
     def get_all_stashes(self):
-        stashes = self.get_all_stash_regions()
-        return [(self.view.substr(s), self.view.substr(self.view.line(s)).strip()) for s in stashes]
+        return [(i.name, i.text) for i in self.get_status_index().stashes]
 
     def get_selected_stashes(self):
-        stashes = []
-        lines = self.get_selected_lines()
-
-        if lines:
-            for s in self.get_all_stash_regions():
-                for l in lines:
-                    if l.contains(s):
-                        name = self.view.substr(s)
-                        title = self.view.substr(self.view.line(s)).strip()
-                        stashes.append((name, title))
-        return stashes
+        return [(i.name, i.text) for i in self.get_selected_items() if i.kind == 'stash']
 
     # file helpers
     def get_all_file_regions(self):
-        return self.view.find_by_selector('meta.git-status.file')
+        return [i.region for i in self.get_status_index().files]
 
     def get_all_files(self):
-        files = self.get_all_file_regions()
-        return [(self.section_at_region(f), self.view.substr(f)) for f in files]
+        index = self.get_status_index()
+        files = []
+        for i in index.files:
+            state = i.text[:1] if i.text.startswith(PATH_PAIR_LABELS) else None
+            files.extend((i.section, name) for name in split_paths(state, i.name))
+        return files + index.hidden
 
     def get_selected_file_regions(self):
         files = []
-        lines = self.get_selected_lines()
-
-        if not lines:
-            return files
-
-        for f in self.get_all_file_regions():
-            for l in lines:
-                if l.contains(f):
-                    # check for renamed
-                    linestr = self.view.substr(l).strip()
-                    if linestr.startswith(STATUS_LABELS['R']) and ' -> ' in linestr:
-                        names = self.view.substr(f)
-                        # find position of divider
-                        e = names.find(' -> ')
-                        s = e + 4
-                        # add both files
-                        f1 = sublime.Region(f.begin(), f.begin() + e)
-                        f2 = sublime.Region(f.begin() + s, f.end())
-                        files.append((self.section_at_region(f), f1))
-                        files.append((self.section_at_region(f), f2))
-                    else:
-                        files.append((self.section_at_region(f), f))
+        for item in self.get_selected_items():
+            if item.kind != 'file':
+                continue
+
+            # check for renamed or copied
+            if item.text.startswith(PATH_PAIR_LABELS) and ' -> ' in item.text:
+                # find position of divider
+                e = item.name.find(' -> ')
+                s = e + 4
+                # add both files
+                files.append((item.section, sublime.Region(item.name_begin, item.name_begin + e)))
+                files.append((item.section, sublime.Region(item.name_begin + s, item.name_end)))
+            else:
+                files.append((item.section, item.region))
 
         return files
 
@@ -299,21 +553,14 @@ class GitStatusTextCmd(GitCmd):
         return [(s, self.view.substr(f)) for s, f in self.get_selected_file_regions()]
 
     def get_status_lines(self):
-        lines = []
-        chunks = self.view.find_by_selector('meta.git-status.line')
-        for c in chunks:
-            lines.extend(self.view.lines(c))
-        return lines
+        return [i.line for i in self.get_status_index().items]
 
     # section helpers
     def get_sections(self):
-        sections = self.view.find_by_selector('constant.other.git-status.header')
-        return sections
+        return self.get_status_index().header_regions()
 
     def section_at_point(self, point):
-        for s in list(SECTIONS.keys()):
-            if self.view.score_selector(point, SECTION_SELECTOR_PREFIX + s) > 0:
-                return s
+        return self.get_status_index().section_at(point)
 
     def section_at_region(self, region):
         return self.section_at_point(region.begin())
@@ -407,110 +654,92 @@ class GitStatusMoveCmd(GitStatusTextCmd):
     def move_to_region(self, region):
         self.move_to_point(self.view.line(region).begin())
 
-    def prev_region(self, regions, point):
-        before = [r for r in regions if self.view.line(r).end() < point]
-        return before[-1] if before else regions[-1]
-
-    def next_region(self, regions, point):
-        after = [r for r in regions if self.view.line(r).begin() > point]
-        return after[0] if after else regions[0]
-
-    def next_or_prev_region(self, direction, regions, point):
-        if direction == "next":
-            return self.next_region(regions, point)
-        else:
-            return self.prev_region(regions, point)
-
     def move_to_section(self, which, where=None):
+        index = self.get_status_index()
         if which in range(1, 5):
-            sections = self.get_sections()
+            sections = index.sections
             if sections and len(sections) >= which:
-                section = sections[which - 1]
-                self.move_to_region(section)
+                self.move_to_point(sections[which - 1][0])
         elif which in list(SECTIONS.keys()):
-            sections = self.get_sections()
-            for section in sections:
-                if self.section_at_region(section) == which:
-                    self.move_to_region(section)
+            for begin, _, _, section in index.sections:
+                if section == which:
+                    self.move_to_point(begin)
                     return
         elif which in ('next', 'prev'):
             point = self.get_first_point()
-            sections = self.get_sections()
+            sections = index.sections
             if point and sections:
-                next = self.next_or_prev_region(which, sections, point)
-                self.move_to_region(next)
+                begins = index.section_begins
+                ends = [e - 1 for _, e, _, _ in sections]
+                self.move_to_point(begins[index.next_or_prev(which, begins, ends, point)])
 
     def move_to_item(self, which=1, where=None):
         if which in ('next', 'prev'):
             point = self.get_first_point()
-            regions = self.get_status_lines()
-            if point and regions:
-                next = self.next_or_prev_region(which, regions, point)
-                self.move_to_region(next)
+            index = self.get_status_index()
+            if point and index.items:
+                self.move_to_point(index.items[index.next_or_prev(which, index.item_begins, index.item_ends, point)].begin)
 
     def move_to_file(self, which=1, where=None):
+        index = self.get_status_index()
+        files = index.files
         if isinstance(which, int):
-            files = self.get_all_file_regions()
             if files:
                 if len(files) >= which:
-                    self.move_to_region(self.view.line(files[which - 1]))
+                    self.move_to_point(files[which - 1].begin)
                 else:
-                    self.move_to_region(self.view.line(files[-1]))
-            elif self.get_all_stash_regions():
+                    self.move_to_point(files[-1].begin)
+            elif index.stashes:
                 self.move_to_stash(1)
             elif self.view.find(GIT_WORKING_DIR_CLEAN, 0, sublime.LITERAL):
                 region = self.view.find(GIT_WORKING_DIR_CLEAN, 0, sublime.LITERAL)
                 self.move_to_region(region)
         elif which in ('next', 'prev'):
             point = self.get_first_point()
-            regions = self.get_all_file_regions()
-            if point and regions:
-                next = self.next_or_prev_region(which, regions, point)
-                self.move_to_region(next)
+            if point and files:
+                self.move_to_point(files[index.next_or_prev(which, index.file_begins, index.file_ends, point)].begin)
         elif which and where:
-            regions = self.get_all_file_regions()
-            section_regions = [r for r in regions if self.section_at_region(r) == where]
-            if section_regions:
-                prev_regions = [r for r in section_regions if self.view.substr(r) < which]
-                next_regions = [r for r in section_regions if self.view.substr(r) >= which]
-                if next_regions:
-                    next = next_regions[0]
+            section_files = [f for f in files if f.section == where]
+            if section_files:
+                prev_files = [f for f in section_files if f.name < which]
+                next_files = [f for f in section_files if f.name >= which]
+                if next_files:
+                    next = next_files[0]
                 else:
-                    next = prev_regions[-1]
-                self.move_to_region(next)
+                    next = prev_files[-1]
+                self.move_to_point(next.begin)
             else:
-                sections = set([self.section_at_region(r) for r in regions])
+                sections = set([f.section for f in files])
                 idx = SECTION_ORDER.index(where)
                 while idx > 0:
                     idx -= 1
                     section = SECTION_ORDER[idx]
                     if section in sections:
-                        section_regions = [r for r in regions if self.section_at_region(r) == section]
-                        self.move_to_region(section_regions[-1])
+                        section_files = [f for f in files if f.section == section]
+                        self.move_to_point(section_files[-1].begin)
                         return
                 self.move_to_file(1)
 
     def move_to_stash(self, which, where=None):
+        stashes = self.get_status_index().stashes
         if which is not None and where:
             which = str(which)
-            stash_regions = self.get_all_stash_regions()
-            if stash_regions:
-                prev_regions = [r for r in stash_regions if self.view.substr(r) < which]
-                next_regions = [r for r in stash_regions if self.view.substr(r) >= which]
-                if next_regions:
-                    next = next_regions[0]
+            if stashes:
+                prev_stashes = [s for s in stashes if s.name < which]
+                next_stashes = [s for s in stashes if s.name >= which]
+                if next_stashes:
+                    next = next_stashes[0]
                 else:
-                    next = prev_regions[-1]
-                self.move_to_region(next)
+                    next = prev_stashes[-1]
+                self.move_to_point(next.begin)
             else:
                 self.move_to_file(1)
         elif isinstance(which, int):
-            stashes = self.get_all_stash_regions()
             if stashes:
                 if len(stashes) >= which:
-                    self.move_to_region(self.view.line(stashes[which - 1]))
+                    self.move_to_point(stashes[which - 1].begin)
                 else:
-                    self.move_to_region(self.view.line(stashes[-1]))
+                    self.move_to_point(stashes[-1].begin)
 
 
 class GitStatusCommand(WindowCommand, GitStatusBuilder):
@@ -554,8 +783,14 @@ class GitStatusReplaceCommand(TextCommand, GitStatusMoveCmd):
 
     def run(self, edit, goto, status):
         self.view.set_read_only(False)
-        self.view.replace(edit, sublime.Region(0, self.view.size()), status)
+        touched = replace_lines(self.view, edit, status)
         self.view.set_read_only(True)
+        logger.debug('status view %s: %s characters changed', self.view.id(), touched)
+
+        # the index built along with the status matches the view now
+        built = built_indexes.pop(self.view.id(), None)
+        if built and built[0] == status:
+            status_indexes[self.view.id()] = (self.view.change_count(), built[1])
 
         if goto:
             self.goto(goto)
@@ -563,16 +798,77 @@ class GitStatusReplaceCommand(TextCommand, GitStatusMoveCmd):
             self.goto(GOTO_DEFAULT)
 
 
+def refresh_status_views(repo):
+    """
+    Bring the status views of a repository up to date, if they need it.
+    Can be called from any thread.
+    """
+    def refresh():
+        for window in sublime.windows():
+            for view in window.views():
+                if view.settings().get('git_view') == 'status' and view.settings().get('git_repo') == repo:
+                    goto = "point:%s" % view.sel()[0].begin() if view.sel() else None
+                    view.run_command('git_status_refresh', {'goto': goto, 'force': False})
+    sublime.set_timeout(refresh, 0)
+
+
+def known_paths(repo):
+    """
+    The repository relative paths of the files open in Sublime Text, and
+    of the changes its status views show, which is what polling watches.
+    """
+    root = os.path.realpath(repo).rstrip(os.sep) + os.sep
+    paths = set()
+    for window in sublime.windows():
+        for view in window.views():
+            filename = view.file_name()
+            if filename and os.path.realpath(filename).startswith(root):
+                paths.add(os.path.relpath(os.path.realpath(filename), root).replace(os.sep, '/'))
+
+            rendered = rendered_status.get(view.id())
+            if rendered and view.settings().get('git_repo') == repo:
+                paths.update(rendered[0].paths)
+                paths.update(f for _, f in rendered[0].untracked)
+    return paths
+
+
 class GitStatusRefreshCommand(TextCommand, GitStatusBuilder):
     _lpop = False
+    priority = PRIORITY_REFRESH
 
     def is_visible(self):
         return False
 
-    def set_status(self, goto, status):
+    def revalidate(self, repo, force, expanded, rendered):
+        snapshot = self.get_repo_state(repo, force=force)
+        if rendered and rendered[:2] == (snapshot, expanded):
+            return snapshot, None, None
+
+        out = self.render_status(repo, expanded=expanded, snapshot=snapshot)
+        return snapshot, out.getvalue(), out.index
+
+    def set_status(self, goto, expanded, built):
+        snapshot, status, index = built
+        view_id = self.view.id()
+        self.view.erase_status(GIT_STATUS_REFRESHING_KEY)
+
+        # keep the view as it is if nothing changed
+        rendered = rendered_status.get(view_id)
+        if rendered and status in (None, rendered[2]):
+            rendered_status[view_id] = (snapshot, expanded, rendered[2])
+            return
+
+        rendered_status[view_id] = (snapshot, expanded, status)
+        built_indexes[view_id] = (status, index)
         self.view.run_command('git_status_replace', {'goto': goto, 'status': status})
 
-    def run(self, edit, goto=None):
+    def on_error(self, e):
+        self.view.erase_status(GIT_STATUS_REFRESHING_KEY)
+
+    def get_ignored_dirs(self, repo):
+        return self.git_lines(['ls-files', '--others', '--ignored', '--exclude-standard', '--directory'], cwd=repo)
+
+    def run(self, edit, goto=None, force=True):
         if not self.view.settings().get('git_view') == 'status':
             return
 
@@ -580,7 +876,27 @@ class GitStatusRefreshCommand(TextCommand, GitStatusBuilder):
         if not repo:
             return
 
-        thread = self.worker_run_async(partial(self.build_status, repo), on_complete=partial(self.set_status, goto))
+        if get_setting('git_watch_repos', False):
+            watch_repo(repo, self.get_git_dirs(repo), on_change=refresh_status_views,
+                       ignored=partial(self.get_ignored_dirs, repo), known=partial(known_paths, repo))
+
+        # unless asked to look again, the view is up to date as long as
+        # what it shows is still the state of the repository
+        expanded = tuple(sorted(self.view.settings().get('git_status_expanded', [])))
+        rendered = rendered_status.get(self.view.id())
+        if not force and rendered and rendered[:2] == (self.peek_repo_state(repo), expanded):
+            return
+
+        # show what we have until git answers. A newer refresh replaces a
+        # queued one, but a forced refresh is only replaced by a forced one,
+        # as the other may be answered from the cache
+        self.view.set_status(GIT_STATUS_REFRESHING_KEY, GIT_STATUS_REFRESHING)
+        thread = self.worker_run_async(partial(self.revalidate, repo, force, expanded, rendered),
+                                       on_complete=partial(self.set_status, goto, expanded),
+                                       on_exception=self.on_error,
+                                       repo=repo, target='status:%s%s' % (self.view.id(), ':force' if force else ''),
+                                       key=('status', self.view.id(), force, expanded),
+                                       description="git status (%s)" % os.path.basename(repo))
         thread.start()
 
 
@@ -591,53 +907,85 @@ class GitStatusEventListener(EventListener):
             goto = None
             if view.sel():
                 goto = "point:%s" % view.sel()[0].begin()
-            view.run_command('git_status_refresh', {'goto': goto})
+            view.run_command('git_status_refresh', {'goto': goto, 'force': False})
+
+    def on_close(self, view):
+        status_indexes.pop(view.id(), None)
+        built_indexes.pop(view.id(), None)
+        rendered_status.pop(view.id(), None)
+
+        # stop watching a repository once its last status view is gone
+        repo = view.settings().get('git_repo')
+        if view.settings().get('git_view') == 'status' and repo:
+            for window in sublime.windows():
+                for other in window.views():
+                    settings = other.settings()
+                    if other.id() != view.id() and settings.get('git_view') == 'status' and settings.get('git_repo') == repo:
+                        return
+            unwatch_repo(repo)
 
 
-class GitStatusBarUpdater(threading.Thread, GitCmd):
+class GitStatusBarUpdater(GitCmd, GitStatusHelper):
     _lpop = False
+    priority = PRIORITY_BACKGROUND
 
-    def __init__(self, bin, encoding, fallback, repo, kind, view, *args, **kwargs):
-        super(GitStatusBarUpdater, self).__init__(*args, **kwargs)
+    def __init__(self, bin, repo, kind, views):
         self.bin = bin
-        self.encoding = encoding
-        self.fallback = fallback
         self.repo = repo
         self.kind = kind
-        self.view = view
+        self.views = views
+
+    def build_command(self, cmd, cwd=None):
+        return self.bin + self.opts + self.repo_opts(cwd) + [c for c in cmd if c]
+
+    def start(self):
+        # a newer update for the same repository replaces any queued one
+        thread = self.worker_run_async(self.run, on_complete=self.set_status, repo=self.repo,
+                                       target='status-bar:%s' % self.repo,
+                                       key=('status-bar', self.repo, self.kind),
+                                       description="status bar update (%s)" % os.path.basename(self.repo))
+        thread.start()
 
-    def build_command(self, cmd):
-        return self.bin + self.opts + [c for c in cmd if c]
+    def set_status(self, msg):
+        if msg:
+            for view in self.views:
+                view.set_status('git-status', msg)
 
     def run(self):
-        branch = self.git_string(['symbolic-ref', '-q', 'HEAD'], cwd=self.repo,
-                                 ignore_errors=True, encoding=self.encoding, fallback=self.fallback)
+        if self.kind == 'simple':
+            # only the branch is shown, so there is no need for git status
+            state = self.peek_repo_probe(self.repo)
+            branch = state.branch if state is not None else self.get_head_branch()
+        else:
+            state = self.get_repo_probe(self.repo)
+            branch = state.branch
         if not branch:
-            return
-
-        branch = branch[11:] if branch.startswith('refs/heads/') else branch
+            return None
 
         if self.kind == 'simple':
             msg = "On {branch}".format(branch=branch)
         else:
-            self.git_exit_code(['update-index', '--refresh'], cwd=self.repo, encoding=self.encoding, fallback=self.fallback)
-            unpushed = self.git_exit_code(['diff', '--exit-code', '--quiet', '@{upstream}..'], cwd=self.repo, encoding=self.encoding, fallback=self.fallback)
-            staged = self.git_exit_code(['diff-index', '--quiet', '--cached', 'HEAD'], cwd=self.repo, encoding=self.encoding, fallback=self.fallback)
-            unstaged = self.git_exit_code(['diff-index', '--quiet', 'HEAD'], cwd=self.repo, encoding=self.encoding, fallback=self.fallback)
             msg = 'On {branch}{dirty} in {repo}{unpushed}'.format(
                 branch=branch,
-                dirty='*' if (staged or unstaged) else '',
+                dirty='*' if state.dirty else '',
                 repo=os.path.basename(self.repo),
-                unpushed=' with unpushed' if unpushed == 1 else ''
+                unpushed=' with unpushed' if state.ahead else ''
             )
 
-        sublime.set_timeout(partial(self.view.set_status, 'git-status', msg), 0)
-        # self.view.set_status('git-status', msg)
+        return msg
+
+    def get_head_branch(self):
+        branch = self.git_string(['symbolic-ref', '-q', 'HEAD'], cwd=self.repo, ignore_errors=True)
+        return branch[11:] if branch.startswith('refs/heads/') else branch
 
 
 class GitStatusBarEventListener(EventListener, GitCmd):
     _lpop = False
 
+    # views waiting for a status bar update, per repository
+    pending = {}
+    pending_lock = threading.Lock()
+
     def on_activated(self, view):
         if sublime.version() < '3000':
             self.set_status(view)
@@ -648,6 +996,7 @@ class GitStatusBarEventListener(EventListener, GitCmd):
 
     def on_post_save(self, view):
         if sublime.version() < '3000':
+            file_saved(view.file_name())
             self.set_status(view)
 
     def on_activated_async(self, view):
@@ -657,6 +1006,7 @@ class GitStatusBarEventListener(EventListener, GitCmd):
         self.set_status(view)
 
     def on_post_save_async(self, view):
+        file_saved(view.file_name())
         self.set_status(view)
 
     def set_status(self, view):
@@ -668,11 +1018,23 @@ class GitStatusBarEventListener(EventListener, GitCmd):
         if not repo:
             return
 
+        # wait a little, so that cycling through tabs only updates
+        # the status bar once per repository
+        with self.pending_lock:
+            views = self.pending.setdefault(repo, {})
+            first = not views
+            views[view.id()] = view
+        if first:
+            delay = get_setting('git_status_bar_delay', 200)
+            sublime.set_timeout(partial(self.start_update, repo, kind), delay)
+
+    def start_update(self, repo, kind):
+        with self.pending_lock:
+            views = list(self.pending.pop(repo, {}).values())
+
         bin = get_executable('git', self.bin)
-        encoding = get_setting('encoding', 'utf-8')
-        fallback = get_setting('fallback_encodings', [])
 
-        updater = GitStatusBarUpdater(bin, encoding, fallback, repo, kind, view)
+        updater = GitStatusBarUpdater(bin, repo, kind, views)
         updater.start()
 
 
@@ -737,6 +1099,43 @@ class GitStatusMoveCommand(TextCommand, GitStatusMoveCmd):
         self.goto(goto)
 
 
+class GitStatusToggleSectionCommand(TextCommand, GitStatusTextCmd):
+    """
+    Show all files of a large section in the status view, or only the
+    first few again. The status is not looked up again unless something
+    has changed.
+    """
+
+    def is_visible(self):
+        return False
+
+    def run(self, edit):
+        point = self.get_first_point()
+        if point is None:
+            return
+
+        section = self.section_key_at_point(point)
+        if not section:
+            return
+
+        expanded = self.view.settings().get('git_status_expanded', [])
+        if section in expanded:
+            expanded.remove(section)
+        else:
+            expanded.append(section)
+        self.view.settings().set('git_status_expanded', expanded)
+
+        self.view.run_command('git_status_refresh', {'goto': "point:%s" % point, 'force': False})
+
+    def section_key_at_point(self, point):
+        # the section as rendered, which tells changes and unmerged changes
+        # apart from unstaged changes, unlike the syntax scopes
+        headers = dict((v, k) for k, v in SECTIONS.items())
+        for begin, header_end, end, _ in self.get_status_index().sections:
+            if begin <= point < end:
+                return headers.get(self.view.substr(sublime.Region(begin, header_end)))
+
+
 class GitStatusStageCommand(TextCommand, GitStatusTextCmd):
 
     def run(self, edit, stage="file"):
@@ -771,10 +1170,10 @@ class GitStatusStageCommand(TextCommand, GitStatusTextCmd):
         self.update_status(goto)
 
     def add(self, repo, files):
-        return self.git(['add', '--'] + files, cwd=repo)
+        return self.git_paths(['add'], files, cwd=repo)
 
     def add_update(self, repo, files):
-        return self.git(['add', '--update', '--'] + files, cwd=repo)
+        return self.git_paths(['add', '--update'], files, cwd=repo)
 
     def add_all(self, repo):
         return self.git(['add', '--all'], cwd=repo)
@@ -783,8 +1182,9 @@ class GitStatusStageCommand(TextCommand, GitStatusTextCmd):
         return self.git(['add', '--update', '.'], cwd=repo)
 
     def add_all_untracked(self, repo):
-        untracked = self.git_lines(['ls-files', '--other', '--exclude-standard'], cwd=repo)
-        return self.git(['add', '--'] + untracked, cwd=repo)
+        # the status view already lists them, collapsed directories included
+        untracked = [f for s, f in self.get_all_files() if s == UNTRACKED_FILES]
+        return self.git_paths(['add'], untracked, cwd=repo)
 
 
 class GitStatusUnstageCommand(TextCommand, GitStatusTextCmd):
@@ -807,12 +1207,12 @@ class GitStatusUnstageCommand(TextCommand, GitStatusTextCmd):
         self.update_status(goto)
 
     def no_commits(self, repo):
-        return 0 != self.git_exit_code(['rev-list', 'HEAD', '--max-count=1'])
+        return self.git_object_info(repo, 'HEAD') is None
 
     def unstage(self, repo, files):
         if self.no_commits(repo):
-            return self.git(['rm', '--cached', '--'] + files, cwd=repo)
-        return self.git(['reset', '-q', 'HEAD', '--'] + files, cwd=repo)
+            return self.git_paths(['rm', '--cached'], files, cwd=repo)
+        return self.git_paths(['reset', '-q', 'HEAD'], files, cwd=repo)
 
     def unstage_all(self, repo):
         if self.no_commits(repo):
@@ -937,9 +1337,10 @@ class GitStatusIgnoreCommand(TextCommand, GitStatusTextCmd):
         return contents
 
 
-class GitStatusDiscardCommand(TextCommand, GitStatusTextCmd):
+class GitStatusDiscardCommand(TextCommand, GitStatusTextCmd, GitStatusHelper, GitErrorHelper):
 
     DELETE_UNTRACKED_CONFIRMATION = "Delete all untracked files and directories?"
+    MAX_LISTED_ACTIONS = 30
 
     def run(self, edit, discard="item"):
         repo = self.get_repo()
@@ -1005,13 +1406,18 @@ class GitStatusDiscardCommand(TextCommand, GitStatusTextCmd):
                 self.git(['stash', 'drop', '--quiet', 'stash@{%s}' % n], cwd=repo)
 
     def discard_files(self, repo, files):
+        # classify everything from one look at the repository
+        snapshot = self.get_status_snapshot(repo, untracked='no')
+        paths = snapshot.paths
+
         # See if any of the files cannot be discarded
         error = "You can't discard staged changes to the following files. Please unstage them or fix merge conflicts first:\n\n  {errfiles}"
         errlist = []
         for s, f in files:
-            if s == STAGED_CHANGES and not self.is_up_to_date(repo, f):
+            staged, unstaged = paths.get(f, (None, None))
+            if s == STAGED_CHANGES and unstaged is not None:
                 errlist.append('%s (unstage)' % f)
-            elif self.get_worktree_status(repo, f) == 'U':
+            elif unstaged == 'U':
                 errlist.append('%s (unmerged)' % f)
 
         if errlist:
@@ -1019,87 +1425,87 @@ class GitStatusDiscardCommand(TextCommand, GitStatusTextCmd):
             sublime.error_message(error.format(errfiles=errfiles))
             return
 
-        # Confirm before unstaging any files
+        # Confirm before unstaging any files, and sort them by what needs doing
         confirm = "Are you sure you want to perform the following actions?\n\n  {actions}"
         actionlist = []
+        untracked, resurrect, delete, submodules, checkout_head, checkout = [], [], [], [], [], []
         for s, f in files:
             staged = s == STAGED_CHANGES
-            status = self.get_staging_status(repo, f) if staged else self.get_worktree_status(repo, f)
-
-            if staged and f in errlist:
-                continue
+            status = paths.get(f, (None, None))[0 if staged else 1]
 
-            if s == UNTRACKED_FILES or status == 'N' or status == 'A':
+            if s == UNTRACKED_FILES:
                 action = 'Delete: '
+                untracked.append(f)
+            elif status == 'N' or status == 'A':
+                action = 'Delete: '
+                delete.append(f)
             elif status == 'D':
                 action = 'Resurrect: '
+                resurrect.append(f)
             else:
                 action = 'Discard: '
+                if f in snapshot.submodules:
+                    submodules.append((staged, f))
+                elif staged:
+                    checkout_head.append(f)
+                else:
+                    checkout.append(f)
 
             actionlist.append("{action} {file}".format(action=action, file=f))
 
         if not actionlist:
             return
 
+        if len(actionlist) > self.MAX_LISTED_ACTIONS:
+            more = len(actionlist) - self.MAX_LISTED_ACTIONS
+            actionlist = actionlist[:self.MAX_LISTED_ACTIONS] + ["... and %s more" % more]
+
         actions = "\n  ".join(actionlist)
         if not sublime.ok_cancel_dialog(confirm.format(actions=actions), 'Continue'):
             return
 
         # perform various unstaging/deleting/resurrection actions
-        submodules = self.get_submodules(repo)
-
-        for s, f in files:
-            staged = s == STAGED_CHANGES
-            status = self.get_staging_status(repo, f) if staged else self.get_worktree_status(repo, f)
-
-            if staged and not self.is_up_to_date(repo, f):
-                continue
-
-            if s == UNTRACKED_FILES:
-                # NB: '--force' is specified twice, otherwise this won't clean git repos (e.g. former submodule)
-                self.git(['clean', '-d', '--force', '--force', '--', f], cwd=repo)
-            elif status == 'D':
-                self.git(['reset', '-q', '--', f], cwd=repo)
-                self.git(['checkout', '--', f], cwd=repo)
-            elif status == 'N' or status == 'A':
-                self.git(['rm', '-f', '--', f], cwd=repo)
-            elif f in submodules:
-                if staged:
-                    self.git(['reset', '-q', 'HEAD', '--', f], cwd=repo)
-
-                self.git(['reset', '--hard'], cwd=os.path.join(repo, f))
-                self.git(['submodule', 'update', '--init', '--recursive', '--', f], cwd=repo)
-            else:
-                if staged:
-                    self.git(['checkout', 'HEAD', '--', f], cwd=repo)
-                else:
-                    self.git(['checkout', '--', f], cwd=repo)
-
-    # status helpers
-
-    def is_up_to_date(self, repo, filename):
-        return self.git_exit_code(['diff', '--quiet', '--', filename], cwd=repo) == 0
-
-    def get_worktree_status(self, repo, filename):
-        # unmerged files have two lines, normal files only one line
-        output = self.git_lines(['diff', '--name-status', '--', filename], cwd=repo)
-        if output:
-            status, _ = output[0].split('\t')
-            return status
-
-    def get_staging_status(self, repo, filename):
-        # unmerged files have two lines, normal files only one line
-        output = self.git_lines(['diff', '--name-status', '--cached', '--', filename], cwd=repo)
-        if output:
-            status, _ = output[0].split('\t')
-            return status
-
-    def get_submodules(self, repo):
-        output = self.git_lines(['submodule', 'status', '--cached'], cwd=repo)
-        if not output:
+        # NB: '--force' is specified twice, otherwise this won't clean git repos (e.g. former submodule)
+        errors = []
+        self.discard_paths(repo, ['clean', '-d', '--force', '--force'], untracked, errors)
+        resurrect = self.discard_paths(repo, ['reset', '-q'], resurrect, errors)
+        self.discard_paths(repo, ['checkout'], resurrect, errors)
+        self.discard_paths(repo, ['rm', '-f', '--ignore-unmatch'], delete, errors)
+        self.discard_paths(repo, ['checkout', 'HEAD'], checkout_head, errors)
+        self.discard_paths(repo, ['checkout'], checkout, errors)
+
+        for staged, f in submodules:
+            if staged:
+                self.git(['reset', '-q', 'HEAD', '--', f], cwd=repo)
+
+            self.git(['reset', '--hard'], cwd=os.path.join(repo, f))
+            self.git(['submodule', 'update', '--init', '--recursive', '--', f], cwd=repo)
+
+        if errors:
+            sublime.error_message("\n".join(errors))
+
+    def discard_paths(self, repo, cmd, paths, errors):
+        """
+        Run a git command on many paths at once. git does nothing at all
+        when one of the paths does not match, so if that fails, run it on
+        one path at a time to do what can be done. Returns the paths it
+        succeeded for, and adds the error of each failure to errors.
+        """
+        exit, stdout, stderr = self.git_paths(cmd, paths, cwd=repo)
+        if exit == 0:
+            return paths
+        if len(paths) == 1:
+            errors.append(self.format_error_output(stdout, stderr).strip())
             return []
 
-        return [line[1:].split(' ')[1] for line in output]
+        done = []
+        for path in paths:
+            exit, stdout, stderr = self.git(cmd + ['--', path], cwd=repo)
+            if exit == 0:
+                done.append(path)
+            else:
+                errors.append(self.format_error_output(stdout, stderr).strip())
+        return done
 
 
 class GitStatusStashCmd(GitStatusTextCmd, GitStashHelper, GitErrorHelper):
@@ -1220,6 +1626,101 @@ class GitStatusCheckoutCommand(TextCommand, GitStatusTextCmd):
         if not sublime.ok_cancel_dialog(confirm.format(actions=actions), 'Continue'):
             return
 
-        for s, f in files:
-            self.git(['checkout', '--%s' % which, '--', f], cwd=repo)
-            self.git(['add', '--', f], cwd=repo)
+        paths = [f for s, f in files]
+        self.git_paths(['checkout', '--%s' % which], paths, cwd=repo)
+        self.git_paths(['add'], paths, cwd=repo)
+
+
+class GitLargeRepoDiagnosticsCommand(WindowCommand, GitCmd, GitStatusHelper):
+    """
+    Show how large repository mode affects git status.
+
+    Reports whether large repository mode is enabled for the current
+    repository, which options it passes to git, and whether git's
+    built-in file system monitor daemon is available and running. Then
+    times ``git status`` with and without those options, and shows how
+    much time each status call saves.
+
+    :setting git_large_repos: Set to ``true`` to use large repository
+        mode for all repositories, or to a list of repository paths to
+        only use it for those. Default: ``false``
+    """
+
+    RUNS = 3
+    priority = PRIORITY_REFRESH
+    measure_opts = None
+
+    def repo_opts(self, cwd):
+        if self.measure_opts is not None:
+            return self.measure_opts
+        return super(GitLargeRepoDiagnosticsCommand, self).repo_opts(cwd)
+
+    def run(self):
+        repo = self.get_repo()
+        if not repo:
+            return
+
+        thread = self.worker_run_async(partial(self.diagnose, repo), on_complete=self.show_report,
+                                       repo=repo, description="large repository diagnostics (%s)" % os.path.basename(repo))
+        thread.start()
+        runner = StatusSpinner(thread, "Timing git status")
+        runner.start()
+
+    def get_config(self, repo, key):
+        # as configured, not as overridden by large repository mode
+        self.measure_opts = []
+        try:
+            return self.git_string(['config', key], cwd=repo)
+        finally:
+            self.measure_opts = None
+
+    def time_status(self, repo, opts):
+        mode = self.get_untracked_mode()
+        cmd = ['status', '--porcelain=v2', '-z', ('--untracked-files=%s' % mode) if mode else None]
+        self.measure_opts = opts
+        try:
+            # the first run may have to fill the untracked cache
+            self.git(cmd, cwd=repo)
+            times = []
+            for _ in range(self.RUNS):
+                start = time.time()
+                self.git(cmd, cwd=repo)
+                times.append(time.time() - start)
+        finally:
+            self.measure_opts = None
+        return min(times)
+
+    def diagnose(self, repo):
+        enabled = self.is_large_repo(repo)
+        opts = self.get_large_repo_opts(repo)
+        lines = ["Repository: %s" % repo,
+                 "Large repository mode: %s" % ("on" if enabled else "off (see git_large_repos)"),
+                 "Options: %s" % " ".join(opts)]
+
+        if not self.has_fsmonitor_daemon():
+            lines.append("File system monitor daemon: not available in this git")
+        else:
+            exit, stdout, stderr = self.git(['fsmonitor--daemon', 'status'], cwd=repo)
+            lines.append("File system monitor daemon: %s" % (stdout or stderr).strip())
+        for key in ('core.fsmonitor', 'core.untrackedCache'):
+            lines.append("%s is configured as: %s" % (key, self.get_config(repo, key) or "(not set)"))
+
+        plain = self.time_status(repo, [])
+        large = self.time_status(repo, opts)
+        saved = plain - large
+        lines += ["",
+                  "git status, best of %s runs:" % self.RUNS,
+                  "  without large repository options: %4d ms" % (plain * 1000),
+                  "  with large repository options:    %4d ms" % (large * 1000),
+                  "  saved per status call:            %4d ms (%d%%)" % (saved * 1000, 100 * saved / plain if plain else 0)]
+
+        recent = self.status_times.get(repo)
+        if recent:
+            lines.append("  recent status calls:              %4d ms on average over %s calls"
+                         % (1000 * sum(recent) / len(recent), len(recent)))
+        return "\n".join(lines) + "\n"
+
+    def show_report(self, report):
+        panel = self.window.get_output_panel('git-large-repo')
+        panel.run_command('git_panel_write', {'content': report})
+        self.window.run_command('show_panel', {'panel': 'output.git-large-repo'})
@@ -2,6 +2,7 @@
 import sys
 from os import path
 import logging
+from difflib import SequenceMatcher
 
 import sublime
 from sublime_plugin import TextCommand
@@ -44,6 +45,64 @@ def find_view_by_settings(window, **kwargs):
             return view
 
 
+def line_delta(old, new, limit=1000000):
+    """
+    The changes needed to turn the text old into new, as a list of
+    (begin, end, text) replacements of whole lines, given as character
+    offsets into old, in order. Equal texts need no changes at all.
+
+    Lines which are the same at the start and the end are skipped
+    right away. The rest is matched line by line, unless that would
+    compare more than limit pairs of lines, in which case it is
+    replaced as a whole.
+    """
+    if old == new:
+        return []
+
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    a_mid = a[prefix:len(a) - suffix]
+    b_mid = b[prefix:len(b) - suffix]
+    if len(a_mid) * len(b_mid) > limit:
+        opcodes = [('replace', 0, len(a_mid), 0, len(b_mid))]
+    else:
+        opcodes = SequenceMatcher(None, a_mid, b_mid, autojunk=False).get_opcodes()
+
+    offsets = [0]
+    for line in a:
+        offsets.append(offsets[-1] + len(line))
+
+    changes = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != 'equal':
+            changes.append((offsets[prefix + i1], offsets[prefix + i2], "".join(b_mid[j1:j2])))
+    return changes
+
+
+def replace_lines(view, edit, content):
+    """
+    Replace the content of the view with the given text, touching only
+    the lines which actually changed. Returns the number of characters
+    which were removed or inserted.
+    """
+    changes = line_delta(view.substr(sublime.Region(0, view.size())), content)
+    # apply from the end, so the offsets of earlier changes stay valid
+    for begin, end, text in reversed(changes):
+        if begin == end:
+            view.insert(edit, begin, text)
+        else:
+            view.replace(edit, sublime.Region(begin, end), text)
+    return sum(end - begin + len(text) for begin, end, text in changes)
+
+
 # progress helper
 
 class StatusSpinner(object):
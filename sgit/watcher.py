@@ -0,0 +1,349 @@
+# coding: utf-8
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+
+from .util import get_setting
+from .state import repo_states, get_fingerprint
+
+
+logger = logging.getLogger('SublimeGit.watcher')
+
+# seconds to wait for things to settle down after a change
+WATCH_DELAY = 0.3
+
+# inotify constants, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+IN_WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                 IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+IN_EVENT = struct.Struct('iIII')
+
+
+def load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class RepoWatcher(threading.Thread):
+    """
+    Watches the working tree and git dirs of a repository, and keeps a
+    dirty set of the paths which have changed.
+
+    Once nothing has changed for a moment, the repository state cache is
+    told which paths changed, and on_change is called with the repository,
+    so whoever shows its status can refresh it. Changes in the git dir are
+    not passed on to the cache, which notices them by itself.
+
+    Subclasses implement watch(), which runs until the watcher is stopped.
+    """
+
+    def __init__(self, repo, git_dirs, on_change=None, ignored=None, known=None):
+        super(RepoWatcher, self).__init__(name='SublimeGit watcher (%s)' % os.path.basename(repo))
+        self.daemon = True
+        self.repo = repo
+        self.git_dirs = git_dirs
+        self.on_change = on_change
+        self.ignored = ignored
+        self.known = known
+        self.skip = set()
+        self.stopped = threading.Event()
+        self.dirty = set()
+        self.everything = False
+        self.last_change = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def setup(self):
+        # ignored directories can get big, like build output or dependencies
+        if callable(self.ignored):
+            try:
+                self.skip = set(d.rstrip('/') for d in self.ignored() if d.endswith('/'))
+            except Exception as e:
+                logger.warning('could not list ignored directories of %s: %s', self.repo, e)
+
+    def walk(self, top=''):
+        """
+        Yield the repository relative paths of the directories below the
+        given one, skipping git dirs and ignored directories.
+        """
+        for root, dirs, files in os.walk(os.path.join(self.repo, top)):
+            rel = os.path.relpath(root, self.repo).replace(os.sep, '/')
+            rel = '' if rel == '.' else rel
+            dirs[:] = [d for d in dirs if d != '.git' and (rel + '/' + d if rel else d) not in self.skip]
+            yield rel, dirs, files
+
+    def changed(self, path):
+        """
+        Mark a repository relative path as changed, or everything if None.
+        """
+        if not path:
+            self.everything = True
+        elif path.split('/', 1)[0] != '.git':
+            self.dirty.add(path)
+        self.last_change = time.time()
+
+    def flush(self):
+        if self.last_change is None or time.time() - self.last_change < WATCH_DELAY:
+            return
+
+        paths = None if self.everything else self.dirty
+        if self.everything or self.dirty:
+            repo_states.touch(self.repo, paths)
+        logger.debug('changes in %s: %s', self.repo, 'everything' if paths is None else len(paths))
+
+        self.dirty = set()
+        self.everything = False
+        self.last_change = None
+        if callable(self.on_change):
+            self.on_change(self.repo)
+
+    def run(self):
+        try:
+            self.setup()
+        except Exception as e:
+            self.close()
+            self.setup_failed(e)
+            return
+
+        try:
+            self.watch()
+        except Exception as e:
+            logger.warning('stopped watching %s: %s', self.repo, e)
+        finally:
+            self.close()
+
+    def setup_failed(self, e):
+        logger.warning('could not watch %s: %s', self.repo, e)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(RepoWatcher):
+    """
+    Uses inotify, with one watch per directory of the working tree.
+    """
+
+    def __init__(self, repo, git_dirs, on_change=None, ignored=None, known=None, libc=None):
+        super(InotifyWatcher, self).__init__(repo, git_dirs, on_change, ignored, known)
+        self.libc = libc
+        self.fd = None
+        self.watches = {}
+        self.git_watches = set()
+
+    def setup(self):
+        super(InotifyWatcher, self).setup()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raise_error()
+
+        for rel, _, _ in self.walk():
+            self.add_watch(rel)
+
+        git_dir, common_dir = self.git_dirs
+        for path in (git_dir, common_dir, os.path.join(common_dir, 'refs', 'heads')):
+            self.git_watches.add(self.add_watch(path, absolute=True))
+
+    def setup_failed(self, e):
+        logger.warning('could not watch %s with inotify, polling instead: %s', self.repo, e)
+        fallback = PollingWatcher(self.repo, self.git_dirs, self.on_change, self.ignored, self.known,
+                                  interval=get_setting('git_watch_poll_interval', 2))
+        with watchers_lock:
+            if watchers.get(self.repo) is not self:
+                return
+            watchers[self.repo] = fallback
+        fallback.start()
+
+    def raise_error(self):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, absolute=False):
+        full = path if absolute else os.path.join(self.repo, path)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(full), IN_WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return None
+            # most likely out of watches, see fs.inotify.max_user_watches
+            self.raise_error()
+        if not absolute:
+            self.watches[wd] = path
+        return wd
+
+    def watch(self):
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.fd], [], [], WATCH_DELAY if self.last_change else 1.0)
+            if readable:
+                try:
+                    self.read_events(os.read(self.fd, 65536))
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            self.flush()
+
+    def read_events(self, data):
+        pos = 0
+        while pos + IN_EVENT.size <= len(data):
+            wd, mask, _, size = IN_EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + IN_EVENT.size:pos + IN_EVENT.size + size].rstrip(b'\0'))
+            pos += IN_EVENT.size + size
+
+            if mask & IN_Q_OVERFLOW:
+                self.changed(None)
+            elif wd in self.git_watches:
+                # lock files come and go with every git command
+                if not name.endswith('.lock'):
+                    self.last_change = time.time()
+            elif wd in self.watches:
+                self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+
+        parent = self.watches[wd]
+        path = parent + '/' + name if parent and name else (name or parent)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and path not in self.skip and name != '.git':
+            for rel, _, _ in self.walk(path):
+                self.add_watch(rel)
+        if name == '.git' or path in self.skip:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            path = parent
+        self.changed(path)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PollingWatcher(RepoWatcher):
+    """
+    For when inotify is not available. Looking at every file of a large
+    working tree every few seconds would cost more than the git status
+    it saves, so only the git dirs and the files known to have changed
+    or to be open are looked at. Other files changed outside of Sublime
+    Text are noticed the next time git itself is asked.
+    """
+
+    def __init__(self, repo, git_dirs, on_change=None, ignored=None, known=None, interval=None):
+        super(PollingWatcher, self).__init__(repo, git_dirs, on_change, ignored, known)
+        self.interval = interval or 2
+        self.mtimes = {}
+        self.fingerprint = None
+
+    def setup(self):
+        # nothing is walked, so there are no ignored directories to skip
+        pass
+
+    def scan(self):
+        paths = set()
+        if callable(self.known):
+            try:
+                paths = set(self.known())
+            except Exception as e:
+                logger.warning('could not list the known files of %s: %s', self.repo, e)
+
+        mtimes = {}
+        for path in paths:
+            try:
+                st = os.lstat(os.path.join(self.repo, path))
+                mtimes[path] = (st.st_mtime, st.st_size, st.st_mode)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def watch(self):
+        self.mtimes = self.scan()
+        self.fingerprint = get_fingerprint(self.git_dirs)
+        while not self.stopped.wait(self.interval):
+            # files which just became known have not changed because of it
+            mtimes = self.scan()
+            for path, stat in mtimes.items():
+                if path in self.mtimes and self.mtimes[path] != stat:
+                    self.changed(path)
+            self.mtimes = mtimes
+
+            fingerprint = get_fingerprint(self.git_dirs)
+            if fingerprint != self.fingerprint:
+                self.fingerprint = fingerprint
+                self.last_change = time.time()
+
+            # the scan itself takes longer than things need to settle
+            if self.last_change is not None:
+                self.last_change = 0
+            self.flush()
+
+
+# the watcher of each repository, indexed by repository root
+watchers = {}
+watchers_lock = threading.Lock()
+
+
+def watch_repo(repo, git_dirs, on_change=None, ignored=None, known=None):
+    """
+    Start watching a repository, unless it is already watched. Uses
+    inotify where available, and polling otherwise. Polling only looks
+    at the repository relative paths returned by known.
+    """
+    with watchers_lock:
+        watcher = watchers.get(repo)
+        if watcher is not None and watcher.is_alive():
+            return watcher
+
+        libc = None if get_setting('git_watch_repos') == 'poll' else load_libc()
+        if libc is not None:
+            watcher = InotifyWatcher(repo, git_dirs, on_change, ignored, known, libc=libc)
+        else:
+            watcher = PollingWatcher(repo, git_dirs, on_change, ignored, known,
+                                     interval=get_setting('git_watch_poll_interval', 2))
+        watchers[repo] = watcher
+        watcher.start()
+        return watcher
+
+
+def unwatch_repo(repo):
+    with watchers_lock:
+        watcher = watchers.pop(repo, None)
+    if watcher is not None:
+        watcher.stop()
+
+
+def stop_watchers():
+    with watchers_lock:
+        stopping = list(watchers.values())
+        watchers.clear()
+    for watcher in stopping:
+        watcher.stop()
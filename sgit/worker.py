@@ -0,0 +1,469 @@
+# coding: utf-8
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import traceback
+from collections import deque
+
+from .util import get_setting
+
+
+worker_logger = logging.getLogger('SublimeGitWorker')
+
+# Number of worker threads used when the git_worker_threads setting is missing
+DEFAULT_MAX_WORKERS = 4
+
+# Priority classes, lower runs first
+PRIORITY_INTERACTIVE = 0  # user actions, like stage, commit or checkout
+PRIORITY_REFRESH = 1      # refreshing a git view, like status or diff
+PRIORITY_BACKGROUND = 2   # anything the user is not waiting for, like the status bar
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_REFRESH, PRIORITY_BACKGROUND)
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_REFRESH: 'refresh',
+    PRIORITY_BACKGROUND: 'background',
+}
+
+# Seconds a caller waits for the output of a job, by priority class, and
+# at most for callers on the UI thread, which freeze the editor meanwhile
+DEFAULT_TIMEOUTS = {
+    'interactive': 120,
+    'refresh': 30,
+    'background': 10,
+    'ui': 10,
+}
+
+
+class JobError(Exception):
+    pass
+
+
+class JobDropped(JobError):
+    pass
+
+
+class JobCancelled(JobError):
+    pass
+
+
+class JobTimeout(JobError):
+    pass
+
+
+def on_ui_thread():
+    return threading.current_thread().name == 'MainThread'
+
+
+def get_timeout(name):
+    timeouts = get_setting('git_command_timeouts', None) or {}
+    timeout = timeouts.get(name, DEFAULT_TIMEOUTS[name])
+    try:
+        return float(timeout) if timeout is not None else None
+    except (TypeError, ValueError):
+        return DEFAULT_TIMEOUTS[name]
+
+
+def job_timeout(priority, ui=False):
+    """
+    How long to wait for the output of a job of the given priority class,
+    or None to wait for as long as it takes. Waiting on the UI thread is
+    kept short, as a fetch or push may hold the repository for minutes.
+    """
+    timeout = get_timeout(PRIORITY_NAMES[priority])
+    if ui:
+        limit = get_timeout('ui')
+        if limit is not None and (timeout is None or limit < timeout):
+            return limit
+    return timeout
+
+
+class JobResult(object):
+    """
+    The output of a job, for callers which block until it is done.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.outputs = None
+
+    def set(self, outputs):
+        self.outputs = outputs
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise JobTimeout("Timed out after %ss" % timeout)
+        return self.outputs
+
+
+def get_thread_stack(thread):
+    frame = sys._current_frames().get(thread.ident, None)
+    if not frame:
+        return []
+
+    return traceback.format_stack(f=frame)
+
+
+class Job(object):
+
+    def __init__(self, task_id, func, on_done, priority=PRIORITY_INTERACTIVE, target=None, key=None, description=None):
+        self.task_id = task_id
+        self.func = func
+        self.waiters = [on_done]
+        self.priority = priority
+        self.target = target
+        self.key = key
+        self.description = description or getattr(func, '__name__', 'job')
+        self.lane = None
+        self.seq = 0
+        self.queued_at = time.time()
+        self.started_at = None
+        self.cancelled = False
+        self.process = None
+        # callers may only be attached to this job while it is running if
+        # it started after this time, as it may not see earlier changes
+        self.fresh_after = None
+
+    @property
+    def running(self):
+        return self.started_at is not None
+
+    def elapsed(self):
+        return time.time() - (self.started_at or self.queued_at)
+
+
+class Lane(object):
+    """
+    A serial queue of jobs. There is one lane per repository, so
+    jobs for the same repository run one at a time, while jobs for
+    different repositories can run side by side.
+
+    Each priority class has its own queue. Jobs of the same class
+    run in the order they were submitted.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.jobs = dict((p, deque()) for p in PRIORITIES)
+        self.busy = False
+        self.current = None
+
+    def queued(self):
+        return sum(len(q) for q in self.jobs.values())
+
+    def depth(self):
+        return self.queued() + (1 if self.busy else 0)
+
+    def peek(self):
+        for p in PRIORITIES:
+            if self.jobs[p]:
+                return self.jobs[p][0]
+
+    def pop(self):
+        for p in PRIORITIES:
+            if self.jobs[p]:
+                return self.jobs[p].popleft()
+
+    def promote(self, job, priority):
+        # move a queued job to a more urgent queue, keeping its place in line
+        if priority >= job.priority or job not in self.jobs[job.priority]:
+            return
+        self.jobs[job.priority].remove(job)
+        queue = self.jobs[priority]
+        idx = 0
+        while idx < len(queue) and queue[idx].seq < job.seq:
+            idx += 1
+        queue.insert(idx, job)
+        job.priority = priority
+
+    def remove(self, job):
+        if job in self.jobs[job.priority]:
+            self.jobs[job.priority].remove(job)
+            return True
+        return False
+
+    def drop(self, target, priority):
+        # drop queued jobs for the same target which are not interactive
+        dropped = []
+        for p in PRIORITIES:
+            if p == PRIORITY_INTERACTIVE or p < priority:
+                continue
+            keep = deque()
+            for job in self.jobs[p]:
+                (dropped if job.target == target else keep).append(job)
+            self.jobs[p] = keep
+        return dropped
+
+
+class Scheduler(object):
+    """
+    Runs jobs on a pool of worker threads, one lane at a time.
+
+    A lane is only ever handled by a single worker at once. Whenever a
+    worker is free it takes the most urgent job among the lanes which are
+    not busy: interactive jobs before view refreshes before background
+    jobs, and the oldest job within a priority class. The size of the pool
+    is capped by the ``git_worker_threads`` setting.
+
+    Jobs submitted with a key are single-flight: while a job with the same
+    key is queued, new callers are attached to it instead of running it
+    again. A running job only takes new callers if it started after their
+    fresh_after time, otherwise they would get output from before a change
+    they should see.
+
+    Jobs can be cancelled. A queued job is simply taken out of its lane,
+    while the process of a running job is terminated. Either way, its
+    callers get a JobCancelled error instead of the output.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.lanes = {}
+        self.inflight = {}
+        self.counters = {'submitted': 0, 'coalesced': 0, 'dropped': 0, 'cancelled': 0}
+        self.seq = 0
+        self.workers = []
+        self.idle = 0
+        self.local = threading.local()
+
+    def max_workers(self):
+        try:
+            return max(1, int(get_setting('git_worker_threads', DEFAULT_MAX_WORKERS)))
+        except (TypeError, ValueError):
+            return DEFAULT_MAX_WORKERS
+
+    def in_worker(self):
+        return getattr(self.local, 'worker', False)
+
+    def running_job(self, key):
+        # the job the lane of a repository is busy with, if any
+        with self.cond:
+            lane = self.lanes.get(key)
+            return lane.current if lane is not None else None
+
+    # queue helpers
+    def submit(self, key, job):
+        dropped = []
+        with self.cond:
+            self.counters['submitted'] += 1
+
+            existing = self.inflight.get(job.key) if job.key is not None else None
+            if existing is not None and existing.running and \
+                    (job.fresh_after is None or existing.started_at < job.fresh_after):
+                existing = None
+            if existing is not None:
+                existing.waiters.extend(job.waiters)
+                existing.lane.promote(existing, job.priority)
+                self.counters['coalesced'] += 1
+                worker_logger.info("[%s,%s] coalesced with %s (%s coalesced so far)",
+                                   threading.get_ident(), job.task_id, existing.task_id, self.counters['coalesced'])
+                return existing
+
+            lane = self.lanes.get(key)
+            if lane is None:
+                lane = self.lanes[key] = Lane(key)
+            job.lane = lane
+
+            if job.target is not None and job.priority != PRIORITY_INTERACTIVE:
+                dropped = lane.drop(job.target, job.priority)
+                for old in dropped:
+                    self.forget(old)
+                self.counters['dropped'] += len(dropped)
+
+            if job.key is not None:
+                self.inflight[job.key] = job
+
+            self.seq += 1
+            job.seq = self.seq
+            lane.jobs[job.priority].append(job)
+
+            worker_logger.info("[%s,%s] queued on lane %s with priority %s (depth %s)",
+                               threading.get_ident(), job.task_id, key, job.priority, lane.depth())
+
+            if self.idle == 0 and len(self.workers) < self.max_workers():
+                self.spawn()
+            self.cond.notify()
+
+        for old in dropped:
+            worker_logger.info("[%s,%s] dropped in favor of %s", threading.get_ident(), old.task_id, job.task_id)
+            self.deliver(old, old.waiters, JobDropped("Superseded by a newer job for %s" % (job.target,)))
+
+        return job
+
+    def forget(self, job):
+        if job.key is not None and self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+
+    def next_lane(self):
+        best = None
+        for lane in self.lanes.values():
+            if lane.busy:
+                continue
+            job = lane.peek()
+            if job is not None and (best is None or (job.priority, job.seq) < best[0]):
+                best = ((job.priority, job.seq), lane)
+        return best[1] if best else None
+
+    def next_job(self):
+        with self.cond:
+            lane = self.next_lane()
+            while lane is None:
+                self.idle += 1
+                self.cond.wait()
+                self.idle -= 1
+                lane = self.next_lane()
+
+            job = lane.pop()
+            job.started_at = time.time()
+            lane.busy = True
+            lane.current = job
+            return lane, job
+
+    def release(self, lane, job):
+        with self.cond:
+            lane.busy = False
+            lane.current = None
+            self.forget(job)
+            if lane.queued():
+                self.cond.notify()
+            elif self.lanes.get(lane.key) is lane:
+                del self.lanes[lane.key]
+            return list(job.waiters)
+
+    def deliver(self, job, waiters, outputs):
+        for on_done in waiters:
+            try:
+                on_done(outputs)
+            except Exception as e:
+                worker_logger.warning("[%s,%s] could not send output: %s", threading.get_ident(), job.task_id, e)
+
+    def queue_depths(self):
+        with self.cond:
+            return dict((key, lane.depth()) for key, lane in self.lanes.items())
+
+    def jobs(self):
+        # running jobs first, then queued jobs in the order they will run
+        with self.cond:
+            running, queued = [], []
+            for lane in self.lanes.values():
+                if lane.current is not None:
+                    running.append(lane.current)
+                for p in PRIORITIES:
+                    queued.extend(lane.jobs[p])
+            running.sort(key=lambda j: j.started_at)
+            queued.sort(key=lambda j: (j.priority, j.seq))
+            return running + queued
+
+    # cancellation
+    def detach(self, job, waiter):
+        # stop waiting for a job, without stopping the job
+        with self.cond:
+            if waiter in job.waiters:
+                job.waiters.remove(waiter)
+
+    def cancel(self, job, waiter=None):
+        """
+        Cancel a job. If a waiter is given and other callers are still
+        attached to the job, only that waiter is detached.
+        """
+        with self.cond:
+            if waiter is not None and waiter in job.waiters:
+                job.waiters.remove(waiter)
+                if job.waiters:
+                    return
+                job.waiters.append(waiter)
+
+            if job.cancelled:
+                return
+            job.cancelled = True
+            self.counters['cancelled'] += 1
+
+            # new callers must not be attached to the job anymore, whether
+            # it is taken out of its lane or still being terminated
+            self.forget(job)
+            queued = job.lane is not None and job.lane.remove(job)
+            if queued and job.lane.depth() == 0 and self.lanes.get(job.lane.key) is job.lane:
+                del self.lanes[job.lane.key]
+            process = job.process
+
+        worker_logger.info("[%s,%s] cancelled (%s)", threading.get_ident(), job.task_id, 'queued' if queued else 'running')
+        if queued:
+            self.deliver(job, list(job.waiters), JobCancelled("Cancelled %s" % job.description))
+        elif process is not None:
+            self.terminate(process)
+
+    def terminate(self, process):
+        # git runs in its own session, so hooks, ssh and the like go down with it
+        try:
+            if process.poll() is None:
+                if hasattr(os, 'killpg'):
+                    os.killpg(process.pid, signal.SIGTERM)
+                else:
+                    process.terminate()
+        except OSError:
+            pass
+
+    def current_job(self):
+        return getattr(self.local, 'job', None)
+
+    def check_cancelled(self):
+        job = self.current_job()
+        if job is not None and job.cancelled:
+            raise JobCancelled("Cancelled %s" % job.description)
+
+    def attach_process(self, process):
+        # remember the process of the running job, so it can be terminated
+        job = self.current_job()
+        if job is None:
+            return
+        with self.cond:
+            job.process = process
+            cancelled = job.cancelled
+        if cancelled:
+            self.terminate(process)
+
+    # workers
+    def spawn(self):
+        thread = threading.Thread(target=self.process, name='SublimeGitWorker-%s' % (len(self.workers) + 1))
+        thread.daemon = True
+        self.workers.append(thread)
+        thread.start()
+
+    def process(self):
+        self.local.worker = True
+        while True:
+            lane, job = self.next_job()
+            task_id = job.task_id
+            self.local.job = job
+            worker_logger.info("[%s,%s] got input on lane %s, processing...", threading.get_ident(), task_id, lane.key)
+
+            try:
+                outputs = job.func()
+                worker_logger.info("[%s,%s] got output, sending...", threading.get_ident(), task_id)
+            except Exception as e:
+                worker_logger.warning("[%s,%s] got error: %s\n%s", threading.get_ident(), task_id, e, traceback.format_exc())
+                worker_logger.warning("[%s,%s] sending...", threading.get_ident(), task_id)
+                outputs = JobError("Unhandled exception in queue command: %s" % e)
+            finally:
+                self.local.job = None
+                waiters = self.release(lane, job)
+
+            if job.cancelled:
+                # follow-up callbacks are dropped along with the job
+                outputs = JobCancelled("Cancelled %s" % job.description)
+
+            self.deliver(job, waiters, outputs)
+
+            worker_logger.info("[%s,%s] sent", threading.get_ident(), task_id)
+
+    def dump_stacks(self, operation, task_id):
+        for thread in list(self.workers):
+            worker_logger.warning("[%s,%s] %s worker thread %s stack:", threading.get_ident(), task_id, operation, thread.name)
+            for entry in get_thread_stack(thread):
+                worker_logger.warning("[%s,%s] " + entry.replace('\r', '').split('\n')[0], threading.get_ident(), task_id)
+
+
+scheduler = Scheduler()
@@ -0,0 +1,90 @@
+# coding: utf-8
+import os
+import sys
+import unittest
+from bisect import bisect_left
+
+# the sgit package needs Sublime Text, the parser does not
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sgit'))
+
+from diffparse import HunkTable, DiffParser, parse_diff  # noqa: E402
+
+
+DIFF = b"""diff --git a/one.txt b/one.txt
+index 1111111..2222222 100644
+--- a/one.txt
++++ b/one.txt
+@@ -1,2 +1,2 @@
+-a
++b
+ c
+@@ -10,1 +10,1 @@
+-d
++e
+diff --git a/two.txt b/two.txt
+index 3333333..4444444 100644
+--- a/two.txt
++++ b/two.txt
+@@ -1 +1 @@
+-f
++g
+diff --git a/three.txt b/three.txt
+index 5555555..6666666 100644
+--- a/three.txt
++++ b/three.txt
+@@ -3,2 +3,3 @@
+ h
++i
+ j
+"""
+
+
+class LimitedTable(HunkTable):
+    """
+    Like the index of a diff view which is still loading: only counts
+    the files and hunks starting before the limit.
+    """
+
+    limit = None
+
+    @property
+    def file_count(self):
+        count = len(self.header_begins)
+        return count if self.limit is None else bisect_left(self.header_begins, self.limit, 0, count)
+
+    @property
+    def hunk_count(self):
+        count = len(self.hunk_begins)
+        return count if self.limit is None else bisect_left(self.hunk_begins, self.limit, 0, count)
+
+
+class DiffParserTest(unittest.TestCase):
+
+    def test_whole_diff(self):
+        table = parse_diff(DIFF)
+        self.assertEqual(table.paths, ['one.txt', 'two.txt', 'three.txt'])
+        self.assertEqual(list(table.hunk_files), [0, 0, 1, 2])
+        self.assertEqual(list(table.file_hunks), [0, 2, 3])
+        self.assertEqual([list(table.hunks_of(f)) for f in range(3)], [[0, 1], [2], [3]])
+
+    def test_chunks_with_limit(self):
+        # the view shows the first file while the rest is still parsed
+        expected = parse_diff(DIFF)
+        for chunk_size in (1, 7, 64, len(DIFF)):
+            table = LimitedTable()
+            parser = DiffParser(table)
+            first = True
+            for pos in range(0, len(DIFF), chunk_size):
+                parser.feed(DIFF[pos:pos + chunk_size])
+                if first and len(table.header_begins) > 1:
+                    table.limit = table.header_begins[1]
+                    first = False
+            parser.close()
+            table.limit = None
+            self.assertEqual(list(table.hunk_files), list(expected.hunk_files), chunk_size)
+            self.assertEqual(list(table.file_hunks), list(expected.file_hunks), chunk_size)
+            self.assertEqual(list(table.hunk_begins), list(expected.hunk_begins), chunk_size)
+
+
+if __name__ == '__main__':
+    unittest.main()